@@ -93,6 +93,9 @@ PRICE_URL = 'http://goonmetrics.com/api/price_data/?station_id=60003760&type_id=
 # Celery broker URL - http://docs.celeryproject.org/en/latest/getting-started/first-steps-with-celery.html#choosing-a-broker
 BROKER_URL = 'redis://%s/0' % os.environ.get('REDIS_1_PORT_6379_TCP_ADDR')
 
+# Redis for the ESI due queue
+ESI_REDIS_URL = 'redis://%s/2' % os.environ.get('REDIS_1_PORT_6379_TCP_ADDR')
+
 # https://docs.djangoproject.com/en/dev/topics/cache/
 # django-redis config
 CACHES = {
@@ -230,6 +230,7 @@ CELERY_STORE_ERRORS_EVEN_IF_IGNORED = True
 # Set up our queues
 CELERY_DEFAULT_QUEUE = 'et_medium'
 CELERY_QUEUES = (
+    Queue('et_fast', Exchange('et_fast'), routing_key='et_fast'),
     Queue('et_medium', Exchange('et_medium'), routing_key='et_medium'),
     Queue('et_high', Exchange('et_high'), routing_key='et_high'),
     Queue('et_low', Exchange('et_low'), routing_key='et_low'),
@@ -273,6 +274,15 @@ CELERYBEAT_SCHEDULE = {
         'options': {
             'queue': 'et_high'
         }
+    },
+
+    # Refresh stale corporations and alliances
+    'esi_entity_refresh': {
+        'task': 'thing.esi.entity_refresh',
+        'schedule': timedelta(minutes=5),
+        'options': {
+            'queue': 'et_low'
+        }
     }
 
     # OLD XML API TASKS
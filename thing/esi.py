@@ -1,97 +1,574 @@
+import os
+import re
 import requests
 import json
 
-from time import sleep
+from time import sleep, time
+from datetime import datetime, timedelta
 from base64 import b64encode
 from urllib import urlencode
 from hashlib import sha256
+from email.utils import parsedate_tz, mktime_tz
+from multiprocessing.pool import ThreadPool
 
+from requests.adapters import HTTPAdapter
 from django.core.cache import cache
+from django.db import connection
 
 from thing.models.esitoken import ESIToken
+from thing.esi_limits import error_limiter, circuit_breaker
 from evething import local_settings
 
 
+# Connection pool settings, shared by every ESI object in a worker process
+ESI_POOL_SIZE = getattr(local_settings, "ESI_POOL_SIZE", 10)
+ESI_CONNECT_TIMEOUT = getattr(local_settings, "ESI_CONNECT_TIMEOUT", 5)
+ESI_READ_TIMEOUT = getattr(local_settings, "ESI_READ_TIMEOUT", 30)
+
+# How long to cache responses that don't tell us when they expire
+ESI_DEFAULT_CACHE_TIME = getattr(local_settings, "ESI_DEFAULT_CACHE_TIME", 30)
+
+# Access tokens are refreshed this many seconds before they expire
+ESI_TOKEN_REFRESH_MARGIN = getattr(local_settings, "ESI_TOKEN_REFRESH_MARGIN", 60)
+# Longest we wait for another process to finish refreshing a token
+ESI_TOKEN_LOCK_TIME = getattr(local_settings, "ESI_TOKEN_LOCK_TIME", 30)
+
+# How long to remember the last ETag and body of an endpoint
+ESI_ETAG_CACHE_TIME = getattr(local_settings, "ESI_ETAG_CACHE_TIME", 6 * 60 * 60)
+
+# How many requests get_many() keeps in flight at once
+ESI_CONCURRENCY = getattr(local_settings, "ESI_CONCURRENCY", 8)
+
+# Longest we wait for another process making the same request, and how often
+# we check whether its answer has arrived
+ESI_FLIGHT_TIME = getattr(local_settings, "ESI_FLIGHT_TIME", ESI_CONNECT_TIMEOUT + ESI_READ_TIMEOUT)
+ESI_FLIGHT_POLL = getattr(local_settings, "ESI_FLIGHT_POLL", 0.1)
+
+_session = None
+_session_pid = None
+
+
+# Returns the keep-alive session for this process. Celery forks its workers
+# after import, so the session is rebuilt if we find ourselves in a new pid
+# rather than sharing sockets with the parent.
+def get_session():
+    global _session, _session_pid
+
+    if _session is None or _session_pid != os.getpid():
+        adapter = HTTPAdapter(
+            pool_connections=ESI_POOL_SIZE,
+            pool_maxsize=ESI_POOL_SIZE,
+            max_retries=0
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        _session = session
+        _session_pid = os.getpid()
+
+    return _session
+
+
+# Works out how many seconds a response stays fresh for from its
+# Cache-Control and Expires headers, returns None if it doesn't say
+def parse_cache_ttl(headers):
+    cache_control = headers.get("Cache-Control", "")
+    if "no-cache" in cache_control or "no-store" in cache_control:
+        return 0
+
+    max_age = re.search(r"max-age=(\d+)", cache_control)
+    if max_age is not None:
+        return int(max_age.group(1))
+
+    expires = parsedate_tz(headers.get("Expires", ""))
+    if expires is None:
+        return None
+
+    # Measure against ESI's clock rather than ours when we can
+    now = parsedate_tz(headers.get("Date", ""))
+    if now is None:
+        now = time()
+    else:
+        now = mktime_tz(now)
+
+    return max(int(mktime_tz(expires) - now), 0)
+
+
+# Raised when part of a paginated endpoint couldn't be fetched
+class ESIIncompleteError(Exception):
+    pass
+
+
+# Raised when ESI is failing (5xx, timeouts, error limited) or the circuit for
+# the endpoint is open. Tasks retry these later rather than here.
+class ESIUnavailableError(Exception):
+    pass
+
+
 # ESI Api wrapper
 class ESI():
     url = local_settings.ESI_URL
     datasource = local_settings.ESI_DATASOURCE
     client_id = local_settings.ESI_CLIENT_ID
     secret_key = local_settings.ESI_SECRET_KEY
+    timeout = (ESI_CONNECT_TIMEOUT, ESI_READ_TIMEOUT)
     token = None
 
+    # Returned by conditional requests when ESI hasn't changed the response
+    # since we last fetched it
+    NOT_MODIFIED = object()
+
 
     # Wrapper for GET
-    def get(self, url, data=None, get_vars={}, cache_time=30, debug=local_settings.DEBUG):
-        return self.request(url, data=data, method=requests.get, get_vars=get_vars, cache_time=cache_time, debug=debug)
+    def get(self, url, data=None, get_vars={}, cache_time=None, debug=local_settings.DEBUG, conditional=False):
+        return self.request(url, data=data, method="GET", get_vars=get_vars, cache_time=cache_time, debug=debug, conditional=conditional)
 
     # Wrapper for POST
-    def post(self, url, data=None, get_vars={}, cache_time=30, debug=local_settings.DEBUG):
-        return self.request(url, data=data, method=requests.post, get_vars=get_vars, cache_time=30, debug=debug)
+    def post(self, url, data=None, get_vars={}, cache_time=None, debug=local_settings.DEBUG):
+        return self.request(url, data=data, method="POST", get_vars=get_vars, cache_time=cache_time, debug=debug)
 
 
-    def request(self, url, data=None, method=requests.get, retries=0, get_vars={}, cache_time=30, debug=local_settings.DEBUG):
-        # Do replacements
-        full_url = self._replacements(url)
+    # Issues independent GETs concurrently, with at most `concurrency` in
+    # flight, and returns the results in the same order. Each entry is either
+    # a url or a (url, kwargs) tuple of extra arguments for get(). A call that
+    # raises (ESIUnavailableError, say) doesn't fail the others, its exception
+    # is returned in its place.
+    def get_many(self, urls, concurrency=ESI_CONCURRENCY):
+        calls = self._calls(urls)
+        if len(calls) == 0:
+            return []
 
-        # Try request
-        full_url = "%s%s?%s" % (self.url, full_url, self._get_variables(get_vars))
+        pool = ThreadPool(min(concurrency, len(calls)))
+        try:
+            return pool.map(lambda call: self._guarded_get(*call), calls)
+        finally:
+            pool.close()
+            pool.join()
 
-        # Check the cache for a response
-        if self.token == None:
-            cache_key = sha256("%s:%s:%s" % (str(method), full_url, json.dumps(data))).hexdigest()
-        else:
-            cache_key = sha256("%s:%s:%s:%s" % (str(method), self.token.access_token, full_url, json.dumps(data))).hexdigest()
-        r = cache.get(cache_key)
-        if r != None:
-            r = json.loads(r)
-            if r == None:
-                return None
+
+    # POSTs each of bodies to the same url concurrently and returns the
+    # results in the same order
+    def post_many(self, url, bodies, cache_time=None, concurrency=ESI_CONCURRENCY):
+        if len(bodies) == 0:
+            return []
+
+        pool = ThreadPool(min(concurrency, len(bodies)))
+        try:
+            return pool.map(lambda data: self._threaded_post(url, data, cache_time), bodies)
+        finally:
+            pool.close()
+            pool.join()
+
+
+    # Runs a GET on a get_many() worker thread. A token refresh can touch the
+    # database, so close whatever connection this thread opened.
+    def _threaded_get(self, url, kwargs):
+        try:
+            return self.get(url, **kwargs)
+        finally:
+            connection.close()
+
+
+    def _guarded_get(self, url, kwargs):
+        try:
+            return self._threaded_get(url, kwargs)
+        except Exception as e:
+            return e
+
+
+    def _threaded_post(self, url, data, cache_time):
+        try:
+            return self.post(url, data=data, cache_time=cache_time)
+        finally:
+            connection.close()
+
+
+    # Normalises a get_many() style list into (url, kwargs) tuples
+    def _calls(self, urls):
+        calls = []
+        for url in urls:
+            if isinstance(url, basestring):
+                calls.append((url, {}))
             else:
-                return r
+                calls.append(url)
+        return calls
+
+
+    # Responses are cached for as long as ESI's Expires/Cache-Control headers
+    # say, cache_time is only used when they don't say. Set conditional=True
+    # to get NOT_MODIFIED back instead of the body when the ETag hasn't
+    # changed since the last time commit_etag() was called for the url.
+    #
+    # Raises ESIUnavailableError if ESI is struggling, APITask reschedules the
+    # task with a backoff when it sees one.
+    def request(self, url, data=None, method="GET", get_vars={}, cache_time=None, debug=local_settings.DEBUG, conditional=False):
+        call = self._prepare(url, data=data, method=method, get_vars=get_vars, cache_time=cache_time, conditional=conditional)
+        if call['cached']:
+            return call['result']
+
+        # Only one process asks ESI a given question at a time, anyone else
+        # asking waits for the answer to turn up in the cache
+        flight_key = None
+        if not conditional:
+            flight_key = "esi:flight:%s" % call['cache_key']
+            if not cache.add(flight_key, 1, ESI_FLIGHT_TIME):
+                if self._await_flight(call['cache_key'], flight_key):
+                    return self.request(url, data=data, method=method, get_vars=get_vars, cache_time=cache_time, debug=debug)
+                # They didn't get an answer we can use, ask for ourselves
+                flight_key = None
+
+        try:
+            return self._fetch(call, debug)
+        finally:
+            if flight_key is not None:
+                cache.delete(flight_key)
+
+
+    # Waits for another process's request to finish. Returns True if its
+    # response is now in the cache.
+    def _await_flight(self, cache_key, flight_key):
+        waited = 0
+        while waited < ESI_FLIGHT_TIME:
+            sleep(ESI_FLIGHT_POLL)
+            waited += ESI_FLIGHT_POLL
+
+            if cache.get(cache_key) is not None:
+                return True
+            if cache.get(flight_key) is None:
+                return cache.get(cache_key) is not None
+
+        return False
+
+
+    # Sends a prepared request to ESI
+    def _fetch(self, call, debug=local_settings.DEBUG):
+        method = call['method']
+        data = call['data']
 
         # Nope, no cache, hit the API
-        r = method(full_url, data=data, headers=self._bearer_header())
+        r = self._send(method, call['full_url'], data, call['etag'])
 
-        if debug:
-            print r.status_code, full_url
+        if debug and r is not None:
+            print r.status_code, call['full_url']
 
-        # If we got a 403 error its an invalid token, try to refresh the token and try again
-        if r.status_code == 403:
-            if self._refresh_access_token():
-                r = method(full_url, data=data, headers=self._bearer_header())
+        # A 403 with a token that's about to expire may just need a fresh
+        # token, try to refresh it and try again. Otherwise it's a real 403
+        # (a missing scope or a forbidden structure) and there's no point.
+        if r is not None and r.status_code == 403 and self.token != None and not self._token_fresh():
+            if self._locked_refresh(stale_token=r.request.headers.get("Authorization")):
+                r = self._send(method, call['full_url'], data, call['etag'])
                 # If the status code is still 403 then we fail the request
-                if r.status_code == 403:
-                    cache.set(cache_key, json.dumps(None), cache_time)
-                    return None
+                if r is not None and r.status_code == 403:
+                    self.statuses[call['full_url']] = 403
+                    return self._fail(call)
             else:
                 return None
 
-        # ESI is buggy, so lets give it up to 10 retries for 500 error
-        if r.status_code in [500, 502, 420]:
-            # If we got 420 just chill for a couple seconds
-            if r.status_code == 420:
-                sleep(5)
+        # ESI is buggy or we're error limited, count it against the endpoint
+        # and leave retrying to the task. A dropped connection or timeout gets
+        # the same treatment.
+        if r is None:
+            self._unavailable(call, None, {})
+        if r.status_code >= 500 or r.status_code == 420:
+            self._unavailable(call, r.status_code, r.headers)
 
-            if retries < local_settings.ESI_RETRIES:
-                return self.request(url, data=data, method=method, retries=retries+1)
-            else:
-                cache.set(cache_key, json.dumps(None), cache_time)
-                return None
+        return self._finish(call, r.status_code, r.headers, r.text)
+
+
+    # Builds the url and cache keys for a request and checks the cache. If
+    # call['cached'] is set, call['result'] already holds the answer.
+    def _prepare(self, url, data=None, method="GET", get_vars={}, cache_time=None, conditional=False):
+        if cache_time is None:
+            cache_time = ESI_DEFAULT_CACHE_TIME
+
+        full_url = self._full_url(url, get_vars)
+
+        # Public routes share one cache entry between every character, so
+        # failures there are only cached when no token was involved as they
+        # might be down to this token's access.
+        scope = self._cache_scope(url)
+        call = {
+            "method": method,
+            "full_url": full_url,
+            "data": data,
+            "cache_time": cache_time,
+            "conditional": conditional,
+            "group": circuit_breaker.group(url),
+            "cache_key": "esi:response:%s:%s" % (scope, self._request_hash(method, full_url, data)),
+            "cache_failures": scope != "public" or self.token == None,
+            "etag_key": self._etag_key(method, scope, full_url, data),
+            "etag": None,
+            "cached": False,
+            "result": None
+        }
+
+        # Conditional requests always revalidate with ESI, a cached body
+        # doesn't tell us whether the caller has already seen it
+        if not conditional:
+            r = cache.get(call['cache_key'])
+            if r != None:
+                r = json.loads(r)
+                self.expiry[full_url] = datetime.fromtimestamp(r['expires'])
+                self.pages[full_url] = r.get('pages', 1)
+                self.etags[full_url] = r.get('etag')
+                call['cached'] = True
+                if r['body'] != None:
+                    call['result'] = json.loads(r['body'])
+                return call
+
+        # Look up the ETag from the last time we fetched this endpoint
+        if call['etag_key'] is not None:
+            etag = cache.get(call['etag_key'])
+            if etag is not None:
+                call['etag'] = json.loads(etag)
+
+        # We're going to hit the API, fail fast if this part of it is down
+        if circuit_breaker.is_open(call['group']):
+            raise ESIUnavailableError("Circuit open for %s" % call['group'])
+
+        # Make sure the token will still be good. If the login server turned
+        # the refresh token down the request fails like a 403 would.
+        refreshed = self._ensure_fresh_token()
+        if refreshed is None:
+            raise ESIUnavailableError("Couldn't refresh the access token for token id %s" % self.token.id)
+        if not refreshed:
+            self.statuses[full_url] = 403
+            call['cached'] = True
+
+        return call
+
+
+    # Records a failed request and raises ESIUnavailableError
+    def _unavailable(self, call, status_code, headers):
+        # We're error limited, the limiter holds every worker back until the
+        # window resets
+        if status_code == 420:
+            if "X-ESI-Error-Limit-Reset" not in headers:
+                error_limiter.exhausted()
+        else:
+            circuit_breaker.failure(call['group'])
+
+        if status_code is None:
+            raise ESIUnavailableError("No response from %s" % call['full_url'])
+        raise ESIUnavailableError("%s from %s" % (status_code, call['full_url']))
+
+
+    # Turns ESI's final answer to a prepared request into its result
+    def _finish(self, call, status_code, headers, text):
+        circuit_breaker.success(call['group'])
+        self.statuses[call['full_url']] = status_code
+
+        # Use ESI's own cache timer when it gives us one
+        ttl = parse_cache_ttl(headers)
+        if ttl is None:
+            ttl = call['cache_time']
+
+        # Nothing changed since the ETag we sent, reuse the body we stored with it
+        etag = call['etag']
+        if status_code == 304 and etag is not None:
+            self._cache_response(call['cache_key'], call['full_url'], etag['body'], ttl, headers)
+            if call['conditional']:
+                return self.NOT_MODIFIED
+            return json.loads(etag['body'])
 
         # Load json and return
-        if r.status_code == 200:
-            j = json.loads(r.text)
-            cache.set(cache_key, r.text, cache_time)
+        if status_code == 200:
+            j = json.loads(text)
+            self._cache_response(call['cache_key'], call['full_url'], text, ttl, headers)
+
+            if call['etag_key'] is not None and "ETag" in headers:
+                # ESI sometimes answers a matching If-None-Match with a full 200
+                if call['conditional'] and etag is not None and etag['etag'] == headers['ETag']:
+                    return self.NOT_MODIFIED
+
+                stored = json.dumps({
+                    "etag": headers['ETag'],
+                    "body": text
+                })
+                if call['conditional']:
+                    # Not seen until the caller has written it, see commit_etag()
+                    self.pending_etags[call['full_url']] = (call['etag_key'], stored)
+                else:
+                    cache.set(call['etag_key'], stored, ESI_ETAG_CACHE_TIME)
+
             return j
         else:
-            cache.set(cache_key, json.dumps(None), cache_time)
+            return self._fail(call)
+
+
+    # Gives up on a prepared request, caching the failure where that's safe
+    def _fail(self, call):
+        if call['cache_failures']:
+            self._cache_response(call['cache_key'], call['full_url'], None, call['cache_time'])
+        return None
+
+
+    # Marks the body a conditional get() or get_pages() of this url returned
+    # as seen, so the next one returns NOT_MODIFIED if it hasn't changed. Call
+    # it once the body has been written, a sync that fails before then gets
+    # the body again next time.
+    def commit_etag(self, url, get_vars={}):
+        pending = self.pending_etags.pop(self._full_url(url, get_vars), None)
+        if pending is not None:
+            key, value = pending
+            cache.set(key, value, ESI_ETAG_CACHE_TIME)
+
+
+    # Returns when the last response we saw for this url stops being fresh,
+    # or None if it hasn't been requested through this object
+    def expires(self, url, get_vars={}):
+        return self.expiry.get(self._full_url(url, get_vars))
+
+
+    # Returns the HTTP status ESI last answered this url with, or None if it
+    # hasn't been requested through this object or came from the cache
+    def status(self, url, get_vars={}):
+        return self.statuses.get(self._full_url(url, get_vars))
+
+
+    # Yields every item of a paginated endpoint. The first page tells us how
+    # many pages there are (X-Pages), the rest are fetched concurrently and
+    # their items yielded as each page arrives, so they aren't in page order.
+    def iter_pages(self, url, get_vars={}, concurrency=ESI_CONCURRENCY):
+        for page, items in self._page_results(url, get_vars, concurrency, ordered=False):
+            for item in items:
+                yield item
+
+
+    # Yields each page of a paginated endpoint in order, fetching the next one
+    # only when it's asked for, so a caller that has seen enough can stop early
+    def walk_pages(self, url, get_vars={}):
+        first = self.get(url, get_vars=get_vars)
+        if first is None:
+            raise ESIIncompleteError("Couldn't fetch page 1 of %s" % url)
+        yield first
+
+        pages = self.pages.get(self._full_url(url, get_vars), 1)
+        for page in range(2, pages + 1):
+            results = self.get(url, get_vars=self._page_vars(get_vars, page))
+            if results is None:
+                raise ESIIncompleteError("Couldn't fetch page %s of %s" % (page, url))
+            yield results
+
+
+    # Returns every item of a paginated endpoint as one list, in page order.
+    # With conditional=True returns NOT_MODIFIED if no page has changed since
+    # the last time commit_etag() was called for the url.
+    def get_pages(self, url, get_vars={}, concurrency=ESI_CONCURRENCY, conditional=False):
+        items = []
+        page_etags = []
+        for page, results in self._page_results(url, get_vars, concurrency, ordered=True):
+            items.extend(results)
+            page_etags.append(self.etags.get(self._full_url(url, self._page_vars(get_vars, page))))
+
+        if conditional and None not in page_etags:
+            full_url = self._full_url(url, get_vars)
+            key = "esi:pages:%s:%s" % (self._cache_scope(url), self._request_hash("GET", full_url, None))
+            signature = sha256(":".join(page_etags)).hexdigest()
+
+            if cache.get(key) == signature:
+                return self.NOT_MODIFIED
+            self.pending_etags[full_url] = (key, signature)
+
+        return items
+
+
+    # Yields (page, results) for each page of a paginated endpoint. Carrying
+    # on without a page would look like everything on it had been deleted, so
+    # a page that can't be fetched raises ESIIncompleteError.
+    def _page_results(self, url, get_vars, concurrency, ordered):
+        first = self.get(url, get_vars=get_vars)
+        if first is None:
+            raise ESIIncompleteError("Couldn't fetch page 1 of %s" % url)
+        yield 1, first
+
+        pages = self.pages.get(self._full_url(url, get_vars), 1)
+        if pages <= 1:
+            return
+
+        calls = [(url, {"get_vars": self._page_vars(get_vars, page)}) for page in range(2, pages + 1)]
+        fetch = lambda call: (call[1]['get_vars']['page'], self._threaded_get(*call))
+
+        pool = ThreadPool(min(concurrency, len(calls)))
+        try:
+            if ordered:
+                results = pool.imap(fetch, calls)
+            else:
+                results = pool.imap_unordered(fetch, calls)
+
+            for page, result in results:
+                if result is None:
+                    raise ESIIncompleteError("Couldn't fetch page %s of %s" % (page, url))
+                yield page, result
+        finally:
+            pool.terminate()
+
+
+    # Page 1 is requested without a page number, the same as a plain get()
+    def _page_vars(self, get_vars, page):
+        if page == 1:
+            return get_vars
+        return dict(get_vars, page=page)
+
+
+    # Caches a response body (None for failures) for ttl seconds and records
+    # when it expires, how many pages there are and its ETag
+    def _cache_response(self, cache_key, full_url, body, ttl, headers={}):
+        pages = int(headers.get("X-Pages", 1))
+        etag = headers.get("ETag")
+
+        self.expiry[full_url] = datetime.now() + timedelta(seconds=ttl)
+        self.pages[full_url] = pages
+        self.etags[full_url] = etag
+
+        # A zero timeout means "forever" to some cache backends
+        if ttl > 0:
+            cache.set(cache_key, json.dumps({
+                "body": body,
+                "expires": time() + ttl,
+                "pages": pages,
+                "etag": etag
+            }), ttl)
+
+
+    # Sends a request over the pooled session, returns None if the connection
+    # failed or timed out
+    def _send(self, method, full_url, data, etag=None):
+        headers = self._bearer_header()
+        if etag is not None:
+            headers['If-None-Match'] = etag['etag']
+
+        # Hold off if we're close to ESI's error limit
+        error_limiter.acquire()
+
+        try:
+            r = get_session().request(
+                method,
+                full_url,
+                data=data,
+                headers=headers,
+                timeout=self.timeout
+            )
+        except requests.exceptions.RequestException:
             return None
 
+        error_limiter.update(r.headers)
+        return r
+
 
     # Takes an ESIToken object as the constructor
     def __init__(self, token=None):
         self.token = token
+        self.expiry = {}
+        self.pages = {}
+        self.etags = {}
+        self.pending_etags = {}
+        self.statuses = {}
+
+
+    def _full_url(self, url, get_vars={}):
+        return "%s%s?%s" % (self.url, self._replacements(url), self._get_variables(get_vars))
 
 
     # Replaces url $variables with their values
@@ -102,6 +579,26 @@ class ESI():
         return url
 
 
+    # Routes that aren't about our character return the same thing whoever
+    # asks, so they're cached once for everyone. Everything else is cached per
+    # character rather than per access token so it survives token refreshes.
+    def _cache_scope(self, url):
+        if self.token == None or "$id" not in url:
+            return "public"
+        return "character:%s" % self.token.characterID
+
+
+    def _request_hash(self, method, full_url, data):
+        return sha256("%s:%s:%s" % (method, full_url, json.dumps(data))).hexdigest()
+
+
+    # ETags are stored per character and endpoint, only GETs have them
+    def _etag_key(self, method, scope, full_url, data):
+        if method != "GET":
+            return None
+        return "esi:etag:%s:%s" % (scope, self._request_hash(method, full_url, data))
+
+
     def _bearer_header(self):
         if self.token == None:
             headers = {}
@@ -113,11 +610,70 @@ class ESI():
 
 
     def _get_variables(self, get_vars):
-        get_vars['datasource'] = self.datasource
-        return urlencode(get_vars)
+        get_vars = dict(get_vars, datasource=self.datasource)
+        return urlencode(sorted(get_vars.items()))
+
+
+    # Refreshes the access token if it's expired or about to, rather than
+    # waiting for ESI to send us a 403. Returns the same as
+    # _refresh_access_token(), or True if there was nothing to do.
+    def _ensure_fresh_token(self):
+        if self.token == None or self._token_fresh():
+            return True
+
+        return self._locked_refresh()
+
 
+    # True if the access token is good for a while yet
+    def _token_fresh(self):
+        expires_at = self.token.expires_at
+        return expires_at is not None and expires_at > datetime.now() + timedelta(seconds=ESI_TOKEN_REFRESH_MARGIN)
 
-    # Refreshes the access token using the refresh token
+
+    # Refreshes the access token with exactly one process at a time doing the
+    # refresh, everyone else waits for it and picks up the new token. Pass the
+    # Authorization header that got rejected as stale_token and the refresh is
+    # skipped if someone has already replaced that token.
+    def _locked_refresh(self, stale_token=None):
+        lock_key = "esi:refresh:%s" % self.token.id
+
+        if cache.add(lock_key, 1, ESI_TOKEN_LOCK_TIME):
+            try:
+                # Someone may have refreshed between our check and the lock
+                self._reload_token()
+                if stale_token is None:
+                    if self._token_fresh():
+                        return True
+                elif self._bearer_header()['Authorization'] != stale_token:
+                    return True
+
+                return self._refresh_access_token()
+            finally:
+                cache.delete(lock_key)
+
+        # Someone else is refreshing this token, wait for them to finish
+        deadline = time() + ESI_TOKEN_LOCK_TIME
+        while cache.get(lock_key) is not None and time() < deadline:
+            sleep(0.2)
+
+        # They may have failed, in which case we don't know any better
+        self._reload_token()
+        if stale_token is None:
+            return self._token_fresh() or None
+        return self._bearer_header()['Authorization'] != stale_token or None
+
+
+    # Picks up the access token another process may have saved
+    def _reload_token(self):
+        token = ESIToken.objects.filter(id=self.token.id).values('access_token', 'expires_at').first()
+        if token is not None:
+            self.token.access_token = token['access_token']
+            self.token.expires_at = token['expires_at']
+
+
+    # Refreshes the access token using the refresh token. Returns True if it
+    # worked, False if the login server turned the refresh token down and
+    # None if it couldn't be reached or gave us something we can't use.
     def _refresh_access_token(self, save=True):
         # Get the new access token
         auth = b64encode("%s:%s" % (self.client_id, self.secret_key))
@@ -128,12 +684,32 @@ class ESI():
             "grant_type": "refresh_token",
             "refresh_token": self.token.refresh_token
         }
-        r = requests.post("https://login.eveonline.com/oauth/token", data=data, headers=headers)
+        try:
+            r = get_session().post("https://login.eveonline.com/oauth/token", data=data, headers=headers, timeout=self.timeout)
+        except requests.exceptions.RequestException:
+            return None
 
-        if save:
-            # Update the ESI token
+        # Revoked or otherwise invalid
+        if r.status_code in (400, 401, 403):
+            return False
+        if r.status_code != 200:
+            return None
+
+        try:
             r = json.loads(r.text)
+        except ValueError:
+            return None
+        if "access_token" not in r or "expires_in" not in r:
+            return None
+
+        if save:
+            # Update the ESI token, only touching the token fields so we don't
+            # clobber anything a running sync has changed
             self.token.access_token = r['access_token']
-            self.token.save()
+            self.token.expires_at = datetime.now() + timedelta(seconds=r['expires_in'])
+            ESIToken.objects.filter(id=self.token.id).update(
+                access_token=self.token.access_token,
+                expires_at=self.token.expires_at
+            )
 
         return True
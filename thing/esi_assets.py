@@ -0,0 +1,53 @@
+# Builds an asset list from ESI into a tree indexed by item_id, so where every
+# item is can be worked out in one pass without touching the database:
+#
+#   tree = AssetTree(assets)
+#   for asset in tree.assets():
+#       tree.parent(asset)  # item_id of the container it's in, or 0
+#       tree.root(asset)    # location_id of the station, structure or
+#                           # system its outermost container is in
+class AssetTree():
+    def __init__(self, assets):
+        self.items = dict((asset['item_id'], asset) for asset in assets)
+        self._roots = {}
+
+
+    def assets(self):
+        return self.items.values()
+
+
+    def parent(self, asset):
+        if asset['location_id'] in self.items:
+            return asset['location_id']
+        return 0
+
+
+    # Walks up to the outermost container, remembering the answer for every
+    # item on the way so each item is only visited once
+    def root(self, asset):
+        path = []
+        item = asset
+        while True:
+            if item['item_id'] in self._roots:
+                root = self._roots[item['item_id']]
+                break
+
+            # ESI has been known to send an item that contains itself
+            if item['item_id'] in path:
+                root = None
+                break
+
+            path.append(item['item_id'])
+            if item['location_id'] not in self.items:
+                root = item['location_id']
+                break
+            item = self.items[item['location_id']]
+
+        for item_id in path:
+            self._roots[item_id] = root
+        return root
+
+
+    # Every location_id an outermost container is in
+    def roots(self):
+        return set(self.root(asset) for asset in self.assets()) - set([None])
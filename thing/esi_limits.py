@@ -0,0 +1,132 @@
+import re
+import json
+
+from time import sleep, time
+
+from django.core.cache import cache
+
+from evething import local_settings
+
+
+# Errors we always keep in hand so we never actually get error limited
+ESI_ERROR_LIMIT_MARGIN = getattr(local_settings, "ESI_ERROR_LIMIT_MARGIN", 10)
+# Below this many remaining errors requests are paced out over the window
+ESI_ERROR_LIMIT_SLOWDOWN = getattr(local_settings, "ESI_ERROR_LIMIT_SLOWDOWN", 50)
+
+# Consecutive failures that open an endpoint group's circuit
+ESI_BREAKER_THRESHOLD = getattr(local_settings, "ESI_BREAKER_THRESHOLD", 5)
+# How long an open circuit fails fast for before letting requests through again
+ESI_BREAKER_OPEN_TIME = getattr(local_settings, "ESI_BREAKER_OPEN_TIME", 60)
+
+
+# ESI gives each IP a budget of errors per window and tells us how much of it
+# is left on every response. The last seen budget is kept in the cache so that
+# every worker slows down together as it runs low, instead of each one finding
+# out from a 420.
+class ESIErrorLimiter():
+    key = "esi:errorlimit"
+
+
+    # Records the budget from a response's X-ESI-Error-Limit headers
+    def update(self, headers):
+        remain = headers.get("X-ESI-Error-Limit-Remain")
+        reset = headers.get("X-ESI-Error-Limit-Reset")
+        if remain is None or reset is None:
+            return
+
+        self._store(int(remain), time() + int(reset))
+
+
+    # We got a 420 without being told when the window resets
+    def exhausted(self, reset=60):
+        self._store(0, time() + reset)
+
+
+    # Seconds to hold off before the next request
+    def delay(self):
+        state = self._state()
+        if state is None:
+            return 0
+
+        reset_in = state['reset_at'] - time()
+        if reset_in <= 0:
+            return 0
+
+        # Out of errors, everyone waits for the window to reset
+        budget = state['remain'] - ESI_ERROR_LIMIT_MARGIN
+        if budget <= 0:
+            return reset_in
+
+        # Running low, spread what's left over the rest of the window
+        if state['remain'] < ESI_ERROR_LIMIT_SLOWDOWN:
+            return reset_in / budget
+
+        return 0
+
+
+    # Blocks until we're allowed to make a request
+    def acquire(self):
+        delay = self.delay()
+        if delay > 0:
+            sleep(min(delay, 60))
+
+
+    def _state(self):
+        state = cache.get(self.key)
+        if state is None:
+            return None
+        return json.loads(state)
+
+
+    def _store(self, remain, reset_at):
+        # Responses from the same window arrive out of order, the lowest
+        # remaining count is the most recent
+        state = self._state()
+        if state is not None and abs(state['reset_at'] - reset_at) < 2 and state['remain'] < remain:
+            return
+
+        cache.set(self.key, json.dumps({
+            "remain": remain,
+            "reset_at": reset_at
+        }), int(reset_at - time()) + 1)
+
+
+# Stops us hammering a part of ESI that is down. Failures are counted per
+# endpoint group (characters/assets, universe/structures, ...) and once a
+# group fails ESI_BREAKER_THRESHOLD times in a row every worker fails fast on
+# it for ESI_BREAKER_OPEN_TIME seconds, then gives it another go.
+class ESICircuitBreaker():
+    # Version numbers and IDs don't make a different endpoint
+    ignored = re.compile(r"^(v\d+|latest|dev|legacy|\$id|\d+|%s)$")
+
+
+    def group(self, url):
+        parts = [part for part in url.split("?")[0].split("/") if part and not self.ignored.match(part)]
+        return "/".join(parts[:2])
+
+
+    def is_open(self, group):
+        return cache.get("esi:breaker:%s:open" % group) is not None
+
+
+    def success(self, group):
+        cache.delete("esi:breaker:%s:failures" % group)
+
+
+    def failure(self, group):
+        key = "esi:breaker:%s:failures" % group
+        if cache.add(key, 1, ESI_BREAKER_OPEN_TIME * 10):
+            failures = 1
+        else:
+            try:
+                failures = cache.incr(key)
+            except ValueError:
+                failures = 1
+
+        if failures >= ESI_BREAKER_THRESHOLD:
+            cache.set("esi:breaker:%s:open" % group, 1, ESI_BREAKER_OPEN_TIME)
+            cache.delete(key)
+
+
+error_limiter = ESIErrorLimiter()
+circuit_breaker = ESICircuitBreaker()
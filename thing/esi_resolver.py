@@ -0,0 +1,174 @@
+import json
+
+from datetime import datetime
+
+from django.db import transaction, IntegrityError
+
+from thing.esi import ESI
+from thing.models.alliance import Alliance
+from thing.models.corporation import Corporation
+from thing.models.character import Character
+
+
+# Most IDs the bulk endpoints take in one request
+ESI_BULK_SIZE = 1000
+
+# last_updated for rows created from names alone, so the next refresh fills in
+# the details (tickers and alliances) that /universe/names/ doesn't give us
+STALE = datetime(0001, 1, 1, 1, 0)
+
+
+# Turns character, corporation and alliance IDs into rows, creating whatever
+# we haven't seen before with a handful of bulk calls instead of one request
+# per entity:
+#
+#   resolver = EntityResolver()
+#   characters = resolver.characters([90000001, 90000002])
+#
+# Unknown characters get their corporation and alliance from
+# /characters/affiliation/, and every missing name comes from a single
+# /universe/names/ call. IDs that ESI doesn't know are left out of the result.
+class EntityResolver():
+    def __init__(self):
+        self.api = ESI()
+
+
+    # Returns {id: Character} for the given character IDs
+    def characters(self, ids):
+        ids = self._ids(ids)
+        found = Character.objects.in_bulk(ids)
+
+        missing = [id for id in ids if id not in found]
+        if len(missing) > 0:
+            affiliations = self._post("/v1/characters/affiliation/", missing)
+            self._create(
+                characters=dict((a['character_id'], a['corporation_id']) for a in affiliations),
+                corporations=dict((a['corporation_id'], a.get('alliance_id')) for a in affiliations),
+                alliances=[a['alliance_id'] for a in affiliations if "alliance_id" in a]
+            )
+            found.update(Character.objects.in_bulk(missing))
+
+        return found
+
+
+    # Returns {id: Corporation} for the given corporation IDs
+    def corporations(self, ids):
+        ids = self._ids(ids)
+        found = Corporation.objects.in_bulk(ids)
+
+        missing = [id for id in ids if id not in found]
+        if len(missing) > 0:
+            # Their alliances turn up when they're next refreshed
+            self._create(corporations=dict((id, None) for id in missing))
+            found.update(Corporation.objects.in_bulk(missing))
+
+        return found
+
+
+    # Returns {id: Alliance} for the given alliance IDs
+    def alliances(self, ids):
+        ids = self._ids(ids)
+        found = Alliance.objects.in_bulk(ids)
+
+        missing = [id for id in ids if id not in found]
+        if len(missing) > 0:
+            self._create(alliances=missing)
+            found.update(Alliance.objects.in_bulk(missing))
+
+        return found
+
+
+    # Creates the rows we don't already have. characters maps character ID to
+    # corporation ID and corporations maps corporation ID to alliance ID.
+    def _create(self, characters={}, corporations={}, alliances=[]):
+        alliances = self._new(Alliance, alliances)
+        corporations = dict((id, corporations[id]) for id in self._new(Corporation, corporations.keys()))
+
+        names = self._names(list(characters.keys()) + corporations.keys() + alliances)
+
+        self._bulk_create(Alliance, [
+            Alliance(id=id, name=names[id], short_name='')
+            for id in alliances if id in names
+        ])
+
+        # Anything ESI didn't name wasn't created, so don't point at it
+        known = self._existing(Alliance, corporations.values())
+        self._bulk_create(Corporation, [
+            Corporation(id=id, name=names[id], alliance_id=alliance_id if alliance_id in known else None)
+            for id, alliance_id in corporations.items() if id in names
+        ])
+
+        known = self._existing(Corporation, characters.values())
+        self._bulk_create(Character, [
+            Character(id=id, name=names[id], corporation_id=corporation_id if corporation_id in known else None)
+            for id, corporation_id in characters.items() if id in names
+        ])
+
+        # auto_now stamps them as fresh, but all we know is their name
+        Alliance.objects.filter(id__in=alliances).update(last_updated=STALE)
+        Corporation.objects.filter(id__in=corporations.keys()).update(last_updated=STALE)
+
+
+    # Returns {id: name} for any mix of IDs
+    def _names(self, ids):
+        if len(ids) == 0:
+            return {}
+        return dict((row['id'], row['name']) for row in self._post("/v2/universe/names/", ids))
+
+
+    # POSTs a list of IDs to a bulk endpoint in chunks. ESI rejects the whole
+    # request if any one ID is invalid, so failed chunks are split in half
+    # until the bad IDs are isolated and dropped.
+    def _post(self, url, ids):
+        results = []
+        for i in range(0, len(ids), ESI_BULK_SIZE):
+            results.extend(self._post_chunk(url, ids[i:i + ESI_BULK_SIZE]))
+        return results
+
+
+    def _post_chunk(self, url, ids):
+        result = self.api.post(url, data=json.dumps(sorted(ids)), cache_time=600)
+        if result is not None:
+            return result
+
+        if len(ids) == 1:
+            return []
+
+        half = len(ids) / 2
+        return self._post_chunk(url, ids[:half]) + self._post_chunk(url, ids[half:])
+
+
+    def _ids(self, ids):
+        return list(set(int(id) for id in ids if id))
+
+
+    # The IDs in ids that have a row
+    def _existing(self, model, ids):
+        ids = self._ids(ids)
+        if len(ids) == 0:
+            return set()
+        return set(model.objects.filter(id__in=ids).values_list('id', flat=True))
+
+
+    # The IDs in ids that don't have a row yet
+    def _new(self, model, ids):
+        existing = self._existing(model, ids)
+        return [id for id in self._ids(ids) if id not in existing]
+
+
+    def _bulk_create(self, model, rows):
+        if len(rows) == 0:
+            return
+
+        try:
+            with transaction.atomic():
+                model.objects.bulk_create(rows)
+        except IntegrityError:
+            # Usually another worker beat us to some of them. Go row by row so
+            # whatever still fails is skipped instead of failing the rest.
+            for row in rows:
+                try:
+                    with transaction.atomic():
+                        row.save(force_insert=True)
+                except IntegrityError as e:
+                    print "Couldn't create %s %s: %s" % (model.__name__, row.id, e)
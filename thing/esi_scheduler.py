@@ -0,0 +1,238 @@
+import random
+
+from time import time
+from uuid import uuid4
+
+import redis
+
+from evething import local_settings
+
+
+# Redis holding the due queue, it has to survive a cache flush
+ESI_REDIS_URL = getattr(local_settings, "ESI_REDIS_URL", "redis://localhost:6379/2")
+# Seconds a worker has to finish a section it's been handed before it's
+# handed out again
+ESI_SECTION_LEASE = getattr(local_settings, "ESI_SECTION_LEASE", 10 * 60)
+# Up to this fraction of a section's interval is added at random to when it's
+# next due, so syncs that happened together drift apart
+ESI_SCHEDULER_JITTER = getattr(local_settings, "ESI_SCHEDULER_JITTER", 0.1)
+# Most sections one user can have queued or running at once
+ESI_USER_MAX_IN_FLIGHT = getattr(local_settings, "ESI_USER_MAX_IN_FLIGHT", 4)
+# How long a sync holds its token's lock for at most, a little longer than
+# CELERYD_TASK_SOFT_TIME_LIMIT
+ESI_SYNC_LOCK_TIME = getattr(local_settings, "ESI_SYNC_LOCK_TIME", 330)
+
+
+# Moves due members to the leased set, scored by when their lease runs out
+CLAIM = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, member in ipairs(due) do
+    redis.call('ZREM', KEYS[1], member)
+    redis.call('ZADD', KEYS[2], ARGV[3], member)
+end
+return due
+"""
+
+# Puts members whose lease ran out back in the due queue
+RECLAIM = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for _, member in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], member)
+    redis.call('ZADD', KEYS[1], ARGV[1], member)
+end
+return #expired
+"""
+
+# Deletes a lock only if we still hold it
+UNLOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Moves a member's score to ARGV[1] if it's still in the set
+EXTEND = """
+if redis.call('ZSCORE', KEYS[1], ARGV[2]) then
+    return redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+end
+return 0
+"""
+
+# Adds members that are in neither set, ARGV is score, member pairs
+ENSURE = """
+local added = 0
+for i = 1, #ARGV, 2 do
+    local member = ARGV[i + 1]
+    if not redis.call('ZSCORE', KEYS[1], member) and not redis.call('ZSCORE', KEYS[2], member) then
+        redis.call('ZADD', KEYS[1], ARGV[i], member)
+        added = added + 1
+    end
+end
+return added
+"""
+
+
+# Hands out each token's sections as they fall due. Due times live in a
+# Redis sorted set, and a section that's been handed out moves to a second
+# set until its worker reports back or its lease runs out, so it's only ever
+# queued once at a time however long the sync takes.
+class DueQueue():
+    due_key = "esi:due"
+    leased_key = "esi:leased"
+
+
+    def __init__(self):
+        self.redis = get_redis()
+        self._claim = self.redis.register_script(CLAIM)
+        self._reclaim = self.redis.register_script(RECLAIM)
+        self._ensure = self.redis.register_script(ENSURE)
+        self._extend = self.redis.register_script(EXTEND)
+
+
+    # Returns up to limit (token id, section) pairs that are due, leasing
+    # them to the caller
+    def claim(self, limit=1000):
+        now = time()
+        self._reclaim(keys=[self.due_key, self.leased_key], args=[now])
+        members = self._claim(keys=[self.due_key, self.leased_key], args=[now, limit, now + ESI_SECTION_LEASE])
+        return [self._split(member) for member in members]
+
+
+    # Adds (token id, section, due timestamp) entries that aren't queued or
+    # leased already
+    def ensure(self, entries, chunk_size=1000):
+        entries = list(entries)
+        added = 0
+        for i in range(0, len(entries), chunk_size):
+            args = []
+            for token_id, section, due in entries[i:i + chunk_size]:
+                args.extend([due, self._member(token_id, section)])
+            added += self._ensure(keys=[self.due_key, self.leased_key], args=args)
+        return added
+
+
+    # Ends the lease on a section and queues it again for due, plus jitter
+    def complete(self, token_id, section, due):
+        now = time()
+        due += random.uniform(0, ESI_SCHEDULER_JITTER * max(0, due - now))
+
+        member = self._member(token_id, section)
+        pipe = self.redis.pipeline()
+        pipe.zrem(self.leased_key, member)
+        pipe.zadd(self.due_key, due, member)
+        pipe.execute()
+
+
+    # Returns {user id: sections in flight} for the given users
+    def in_flight(self, user_ids):
+        now = time()
+        user_ids = list(user_ids)
+
+        pipe = self.redis.pipeline()
+        for user_id in user_ids:
+            pipe.zremrangebyscore(self._user_key(user_id), '-inf', now)
+            pipe.zcard(self._user_key(user_id))
+        counts = pipe.execute()[1::2]
+
+        return dict(zip(user_ids, counts))
+
+
+    # Records that a section has been queued for a user, until finish() is
+    # called or its lease runs out
+    def start(self, user_id, token_id, section):
+        key = self._user_key(user_id)
+        pipe = self.redis.pipeline()
+        pipe.zadd(key, time() + ESI_SECTION_LEASE, self._member(token_id, section))
+        pipe.expire(key, ESI_SECTION_LEASE)
+        pipe.execute()
+
+
+    def finish(self, user_id, token_id, section):
+        self.redis.zrem(self._user_key(user_id), self._member(token_id, section))
+
+
+    # Keeps a section leased and in flight for another seconds, for when its
+    # task is retried later rather than finished
+    def extend(self, user_id, token_id, section, seconds):
+        until = time() + seconds
+        member = self._member(token_id, section)
+        self._extend(keys=[self.leased_key], args=[until, member])
+        self._extend(keys=[self._user_key(user_id)], args=[until, member])
+        self.redis.expire(self._user_key(user_id), int(seconds) + 1)
+
+
+    # Drops every section of a token
+    def remove(self, token_id, sections):
+        members = [self._member(token_id, section) for section in sections]
+        pipe = self.redis.pipeline()
+        pipe.zrem(self.due_key, *members)
+        pipe.zrem(self.leased_key, *members)
+        pipe.execute()
+
+
+    def _user_key(self, user_id):
+        return "esi:inflight:%s" % user_id
+
+
+    def _member(self, token_id, section):
+        return "%s:%s" % (token_id, section)
+
+
+    def _split(self, member):
+        token_id, section = member.split(":", 1)
+        return int(token_id), section
+
+
+class TokenLocked(Exception):
+    pass
+
+
+# Only one sync writes a token's data at a time. The lock is a lease, so a
+# worker that dies holding it only holds things up for ESI_SYNC_LOCK_TIME.
+#
+#   with TokenLock(token.id):
+#       ...
+#
+# raises TokenLocked if another sync has it.
+class TokenLock():
+    def __init__(self, token_id):
+        self.redis = get_redis()
+        self.key = "esi:lock:%s" % token_id
+        self.owner = uuid4().hex
+
+
+    def acquire(self):
+        return bool(self.redis.set(self.key, self.owner, nx=True, ex=ESI_SYNC_LOCK_TIME))
+
+
+    def release(self):
+        self.redis.register_script(UNLOCK)(keys=[self.key], args=[self.owner])
+
+
+    def __enter__(self):
+        if not self.acquire():
+            raise TokenLocked(self.key)
+        return self
+
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+
+
+_redis = None
+_queue = None
+
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.StrictRedis.from_url(ESI_REDIS_URL)
+    return _redis
+
+
+def get_due_queue():
+    global _queue
+    if _queue is None:
+        _queue = DueQueue()
+    return _queue
@@ -0,0 +1,73 @@
+from django.db import connection, transaction
+
+
+# Brings a set of rows in line with what ESI sent, with one query to load
+# what we have and bulk writes for whatever changed:
+#
+#   counts = sync_rows(
+#       FactionStanding.objects.filter(character=character),
+#       'faction',
+#       [FactionStanding(character=character, faction_id=..., standing=...), ...],
+#       ['standing']
+#   )
+#
+# Rows are matched on key, a field name or a tuple of them, and only the
+# listed fields are compared and updated. Rows we have that ESI didn't send
+# are deleted unless delete=False. Returns how many rows were created,
+# updated and deleted.
+def sync_rows(queryset, key, rows, fields, delete=True):
+    model = queryset.model
+    keys = (key,) if isinstance(key, basestring) else tuple(key)
+    key_fields = [model._meta.get_field(name) for name in keys]
+    value_fields = [model._meta.get_field(name) for name in fields]
+
+    existing = {}
+    for row in queryset.values_list('pk', *(keys + tuple(fields))):
+        row_key = _prep(key_fields, row[1:len(keys) + 1])
+        existing[row_key] = (row[0], _prep(value_fields, row[len(keys) + 1:]))
+
+    new_rows = []
+    # {prepared values: (values, pks)}, so rows that changed to the same
+    # values share an UPDATE. There's no bulk_update in this Django.
+    changed = {}
+    seen = set()
+    for row in rows:
+        row_key = _prep(key_fields, [getattr(row, field.attname) for field in key_fields])
+        if row_key in seen:
+            continue
+        seen.add(row_key)
+
+        values = [getattr(row, field.attname) for field in value_fields]
+        if row_key not in existing:
+            new_rows.append(row)
+            continue
+
+        pk, old_values = existing[row_key]
+        prepped = _prep(value_fields, values)
+        if prepped != old_values:
+            changed.setdefault(prepped, (values, []))[1].append(pk)
+
+    stale = []
+    if delete:
+        stale = [pk for row_key, (pk, old_values) in existing.items() if row_key not in seen]
+
+    updated = 0
+    with transaction.atomic():
+        model.objects.bulk_create(new_rows, batch_size=1000)
+        for values, pks in changed.values():
+            model.objects.filter(pk__in=pks).update(**dict(zip(fields, values)))
+            updated += len(pks)
+        if len(stale) > 0:
+            model.objects.filter(pk__in=stale).delete()
+
+    return {
+        "created": len(new_rows),
+        "updated": updated,
+        "deleted": len(stale)
+    }
+
+
+# Values as the database would store them, so a float from ESI compares
+# equal to the Decimal we read back
+def _prep(fields, values):
+    return tuple(field.get_db_prep_save(value, connection) for field, value in zip(fields, values))
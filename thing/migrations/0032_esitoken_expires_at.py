@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thing', '0031_auto_20171209_2326'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='esitoken',
+            name='expires_at',
+            field=models.DateTimeField(default=None, null=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import datetime
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thing', '0032_esitoken_expires_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ESITokenSection',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(max_length=32)),
+                ('next_update', models.DateTimeField(default=datetime.datetime.now, db_index=True)),
+                ('last_updated', models.DateTimeField(default=None, null=True)),
+                ('token', models.ForeignKey(related_name='sections', to='thing.ESIToken')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='esitokensection',
+            unique_together=set([('token', 'name')]),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thing', '0033_esitokensection'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='esitokensection',
+            name='checksum',
+            field=models.CharField(default='', max_length=64),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='esitokensection',
+            name='last_changed',
+            field=models.DateTimeField(default=None, null=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='esitokensection',
+            name='unchanged_runs',
+            field=models.IntegerField(default=0),
+            preserve_default=True,
+        ),
+    ]
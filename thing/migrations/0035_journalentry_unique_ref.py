@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# Concurrent syncs could insert the same entry twice, keep the oldest row
+def delete_journal_duplicates_forward(apps, schema_editor):
+    JournalEntry = apps.get_model('thing', 'JournalEntry')
+    duplicates = JournalEntry.objects.values('character', 'ref_id').annotate(
+        count=models.Count('id'),
+        keep=models.Min('id')
+    ).filter(count__gt=1)
+
+    for duplicate in duplicates:
+        JournalEntry.objects.filter(
+            character=duplicate['character'],
+            ref_id=duplicate['ref_id']
+        ).exclude(id=duplicate['keep']).delete()
+
+
+def delete_journal_duplicates_reverse(apps, schema_editor):
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('thing', '0034_esitokensection_changes'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            delete_journal_duplicates_forward,
+            delete_journal_duplicates_reverse
+        ),
+        migrations.AlterUniqueTogether(
+            name='journalentry',
+            unique_together=set([('character', 'ref_id')]),
+        ),
+    ]
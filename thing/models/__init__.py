@@ -27,6 +27,7 @@ from thing.models.implant import Implant
 
 # ESI
 from thing.models.esitoken import ESIToken
+from thing.models.esitokensection import ESITokenSection
 from thing.models.serverstatus import ServerStatus
 
 # Everything else
@@ -23,7 +23,7 @@
 # OF SUCH DAMAGE.
 # ------------------------------------------------------------------------------
 
-from datetime import datetime, timedelta
+from datetime import datetime
 
 from django.db import models
 
@@ -38,13 +38,14 @@ class Alliance(models.Model):
         app_label = 'thing'
 
 
+    # Stale alliances are returned as they are, ESI_EntityRefresh updates them
     @staticmethod
     def get_or_create(alliance_id):
         from thing.esi import ESI
-        api = ESI()
 
         db_alliance = Alliance.objects.filter(id=alliance_id)
         if len(db_alliance) == 0:
+            api = ESI()
             alliance = api.get("/v3/alliances/%s/" % alliance_id)
             db_alliance = Alliance(
                 id=alliance_id,
@@ -55,11 +56,4 @@ class Alliance(models.Model):
 
             return db_alliance
         else:
-            db_alliance = db_alliance[0]
-            if db_alliance.last_updated < datetime.now() - timedelta(days=2):
-                alliance = api.get("/v3/alliances/%s/" % alliance_id)
-                db_alliance.name = alliance['name']
-                db_alliance.short_name = alliance['ticker']
-                db_alliance.save()
-
-            return db_alliance
+            return db_alliance[0]
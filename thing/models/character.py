@@ -44,24 +44,12 @@ class Character(models.Model):
         return self.name
 
 
+    # Use EntityResolver directly when there's more than one to look up
     @staticmethod
     def get_or_create(id):
-        from thing.esi import ESI
+        from thing.esi_resolver import EntityResolver
 
-        db_char = Character.objects.filter(id=id)
-        if len(db_char) == 0:
-            api = ESI()
-            char = api.get("/v4/characters/%s/" % id)
-            db_char = Character(
-                id=id,
-                name=char['name'],
-                corporation=Corporation.get_or_create(char['corporation_id'])
-            )
-            db_char.save()
-        else:
-            db_char = db_char[0]
-
-        return db_char
+        return EntityResolver().characters([id]).get(int(id))
 
 
     def is_training(self):
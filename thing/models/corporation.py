@@ -23,7 +23,7 @@
 # OF SUCH DAMAGE.
 # ------------------------------------------------------------------------------
 
-from datetime import datetime, timedelta
+from datetime import datetime
 
 from django.db import models
 from django.db.models import Sum
@@ -58,6 +58,7 @@ class Corporation(models.Model):
         return self.corpwallet_set.aggregate(Sum('balance'))['balance_sum']
 
 
+    # Stale corporations are returned as they are, ESI_EntityRefresh updates them
     @staticmethod
     def get_or_create(corporation_id):
         from thing.esi import ESI
@@ -68,7 +69,8 @@ class Corporation(models.Model):
             corporation = api.get("/v4/corporations/%s/" % corporation_id)
             db_corporation = Corporation(
                 id=corporation_id,
-                name=corporation['name']
+                name=corporation['name'],
+                ticker=corporation['ticker']
                 )
 
             if "alliance_id" in corporation:
@@ -80,19 +82,7 @@ class Corporation(models.Model):
 
             return db_corporation
         else:
-            db_corporation = corporation[0]
-            if db_corporation.last_updated < datetime.now() - timedelta(days=2):
-                api = ESI()
-                corporation = api.get("/v4/corporations/%s/" % corporation_id)
-                db_corporation.name = corporation['name']
-
-                if "alliance_id" in corporation:
-                    db_corporation.alliance = Alliance.get_or_create(corporation['alliance_id'])
-                else:
-                    db_corporation.alliance = None
-
-                db_corporation.save()
-            return db_corporation
+            return corporation[0]
 
 
     @staticmethod
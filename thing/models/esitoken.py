@@ -9,6 +9,7 @@ from thing.models.eveaccount import EveAccount
 class ESIToken(models.Model):
     access_token = models.CharField(max_length=128)
     refresh_token = models.CharField(max_length=320)
+    expires_at = models.DateTimeField(default=None, null=True)
 
     user = models.ForeignKey(User)
     account = models.ForeignKey(EveAccount, related_name="tokens", null=True, default=None, on_delete=models.SET_NULL)
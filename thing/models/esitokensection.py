@@ -0,0 +1,25 @@
+from datetime import datetime
+
+from django.db import models
+
+from thing.models.esitoken import ESIToken
+
+
+# When each section of a token's data (skills, assets, ...) was last synced
+# and when it's due again
+class ESITokenSection(models.Model):
+    token = models.ForeignKey(ESIToken, related_name="sections")
+    name = models.CharField(max_length=32)
+
+    next_update = models.DateTimeField(default=datetime.now, db_index=True)
+    last_updated = models.DateTimeField(default=None, null=True)
+
+    # When the section's data last changed, and how many syncs since then
+    # have found the same thing
+    last_changed = models.DateTimeField(default=None, null=True)
+    unchanged_runs = models.IntegerField(default=0)
+    checksum = models.CharField(max_length=64, default='')
+
+    class Meta:
+        app_label = 'thing'
+        unique_together = ('token', 'name')
@@ -60,6 +60,7 @@ class JournalEntry(models.Model):
     class Meta:
         app_label = 'thing'
         ordering = ('-date',)
+        unique_together = ('character', 'ref_id')
 
     def ref_type_display(self):
         return self.ref_type.replace("_", " ").title()
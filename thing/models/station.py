@@ -23,14 +23,32 @@
 # OF SUCH DAMAGE.
 # ------------------------------------------------------------------------------
 
+import json
+
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from time import time
 
+from django.core.cache import cache
 from django.db import models
 
 from evething import local_settings
 from thing.models.system import System
 from thing.models.item import Item
 
+
+# Stations looked up by this process are kept in memory, up to this many
+ESI_STATION_LRU_SIZE = getattr(local_settings, "ESI_STATION_LRU_SIZE", 20000)
+# How long a process trusts its own copy before checking the shared cache
+ESI_STATION_LRU_TIME = getattr(local_settings, "ESI_STATION_LRU_TIME", 10 * 60)
+# How long stations are kept in the shared cache
+ESI_STATION_CACHE_TIME = getattr(local_settings, "ESI_STATION_CACHE_TIME", 24 * 60 * 60)
+# How long we remember that an ID isn't a station or structure
+ESI_STATION_MISSING_TIME = getattr(local_settings, "ESI_STATION_MISSING_TIME", 7 * 24 * 60 * 60)
+
+# id: (expires at, Station or None)
+_lru = OrderedDict()
+
 numeral_map = zip(
     (1000, 900, 500, 400, 100, 90, 50, 40, 10, 9, 5, 4, 1),
     ('M', 'CM', 'D', 'CD', 'C', 'XC', 'L', 'XL', 'X', 'IX', 'V', 'IV', 'I')
@@ -62,15 +80,23 @@ class Station(models.Model):
         app_label = 'thing'
 
 
-    # Used to add structures
+    # Used to add structures. Lookups go through this process's LRU and the
+    # shared cache before the database, IDs that turn out not to be a
+    # station or structure are remembered for ESI_STATION_MISSING_TIME.
     @staticmethod
     def get_or_create(id, api):
+        from thing.esi import ESIUnavailableError
+
+        found, station = Station._cached(id)
+        if found:
+            return station
+
         # Check database for station/structure
         station = Station.objects.filter(id=id)
         if len(station) == 1:
             station = station[0]
             if not station.structure:
-                return station
+                return Station._remember(station)
             else:
                 if station.lastupdated < datetime.now() - timedelta(days=14):
                     # Update the structures name from the API
@@ -79,12 +105,15 @@ class Station(models.Model):
                         station.name = r['name']
                         station.system_id = r['solar_system_id']
                         station.save()
-                return station
+                return Station._remember(station)
 
         try:
             # Check if its a sov station we don't have yet
             if id < 71001146:
                 r = api.get("/v2/universe/stations/%s/" % id)
+                if r is None:
+                    return Station._remember_missing(id)
+
                 station = Station(
                     id=id,
                     name=r['name'],
@@ -92,8 +121,12 @@ class Station(models.Model):
                     structure=False
                 )
             else:
-                # It doesn't exist, lets create it
+                # It doesn't exist, lets create it. Structures we can't
+                # dock at are still created, just without a name.
                 r = api.get("/v1/universe/structures/%s/" % id)
+                if r is None and api.status("/v1/universe/structures/%s/" % id) == 404:
+                    return Station._remember_missing(id)
+
                 station = Station(
                     id=id,
                     structure=True
@@ -104,13 +137,104 @@ class Station(models.Model):
                     station.item_id = r['type_id']
 
             station.save()
-            return station
+            return Station._remember(station)
 
+        except ESIUnavailableError:
+            # Try again when ESI is back rather than remembering it as missing
+            raise
         except Exception:
             # We crashed out, it must not be a structure
             return None
 
 
+    # Loads every station and structure in ids into this process's LRU with
+    # one cache round trip and one query, so a sync that's about to look up
+    # lots of locations doesn't do it one at a time
+    @staticmethod
+    def prefetch(ids):
+        now = time()
+        ids = set(id for id in ids if id and not (id in _lru and _lru[id][0] > now))
+        if len(ids) == 0:
+            return
+
+        cached = cache.get_many(["station:%s" % id for id in ids])
+        for key, value in cached.items():
+            id = int(key.split(":")[1])
+            Station._lru_set(id, Station._loads(value))
+            ids.discard(id)
+
+        for station in Station.objects.filter(id__in=ids):
+            # Structures due a refresh are left to get_or_create
+            if station.structure and station.lastupdated < datetime.now() - timedelta(days=14):
+                continue
+            Station._remember(station)
+
+
+    # Returns (True, Station or None) if the lookup is cached, else (False, None)
+    @staticmethod
+    def _cached(id):
+        entry = _lru.pop(id, None)
+        if entry is not None and entry[0] > time():
+            _lru[id] = entry
+            return True, entry[1]
+
+        value = cache.get("station:%s" % id)
+        if value is None:
+            return False, None
+
+        station = Station._loads(value)
+        Station._lru_set(id, station)
+        return True, station
+
+
+    @staticmethod
+    def _remember(station):
+        cache.set("station:%s" % station.id, Station._dumps(station), ESI_STATION_CACHE_TIME)
+        Station._lru_set(station.id, station)
+        return station
+
+
+    @staticmethod
+    def _remember_missing(id):
+        cache.set("station:%s" % id, Station._dumps(None), ESI_STATION_MISSING_TIME)
+        Station._lru_set(id, None)
+        return None
+
+
+    @staticmethod
+    def _lru_set(id, station):
+        _lru.pop(id, None)
+        _lru[id] = (time() + ESI_STATION_LRU_TIME, station)
+        while len(_lru) > ESI_STATION_LRU_SIZE:
+            _lru.popitem(last=False)
+
+
+    @staticmethod
+    def _dumps(station):
+        if station is None:
+            return json.dumps(None)
+
+        return json.dumps({
+            "id": station.id,
+            "name": station.name,
+            "short_name": station.short_name,
+            "structure": station.structure,
+            "item_id": station.item_id,
+            "system_id": station.system_id,
+            "lastupdated": (station.lastupdated or datetime.now()).strftime("%Y-%m-%dT%H:%M:%S")
+        })
+
+
+    @staticmethod
+    def _loads(value):
+        fields = json.loads(value)
+        if fields is None:
+            return None
+
+        fields['lastupdated'] = datetime.strptime(fields['lastupdated'], "%Y-%m-%dT%H:%M:%S")
+        return Station(**fields)
+
+
     def __unicode__(self):
         return self.name
 
@@ -23,6 +23,34 @@
 # OF SUCH DAMAGE.
 # ------------------------------------------------------------------------------
 
+# Sets the names of many of a character's assets at once, filled in with a
+# WHEN asset_id THEN name for each asset and a placeholder per asset_id
+asset_names = """
+UPDATE  thing_asset
+SET     name = CASE asset_id %s END
+WHERE   character_id = %%s
+        AND asset_id IN (%s)
+"""
+
+# Rebuilds a character's asset summary, one row per station and one per
+# system for anything in space
+asset_summary = """
+INSERT INTO thing_assetsummary (character_id, corporation_id, system_id, station_id, total_items, total_volume, total_value)
+SELECT  a.character_id,
+        0,
+        COALESCE(a.system_id, s.system_id),
+        a.station_id,
+        SUM(a.quantity),
+        COALESCE(SUM(a.quantity * i.volume), 0),
+        COALESCE(SUM(a.quantity * i.sell_price), 0)
+FROM    thing_asset a
+INNER JOIN thing_item i ON i.id = a.item_id
+LEFT OUTER JOIN thing_station s ON s.id = a.station_id
+WHERE   a.character_id = %s
+        AND COALESCE(a.system_id, s.system_id) IS NOT NULL
+GROUP BY a.character_id, COALESCE(a.system_id, s.system_id), a.station_id
+"""
+
 corporation_wallets = """
 SELECT  cw.corporation_id, c.name, cw.account_key, cw.description, cw.balance
 FROM    thing_corpwallet cw
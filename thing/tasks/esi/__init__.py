@@ -1,6 +1,8 @@
 from characterinfo import *
+from async import *
 from character_update_spawner import *
 from market_updater import *
 from mail_fetch_task import *
 from server_status import *
+from entity_refresh import *
 from clear_invalid_keys import *
\ No newline at end of file
@@ -1,11 +1,20 @@
+import random
 import datetime
 
 from celery import Task
 from celery.task.control import broadcast
 from celery.utils.log import get_task_logger
 
+from evething import local_settings
+
 from thing.models.esitoken import ESIToken
-from thing.esi import ESI
+from thing.esi import ESI, ESIUnavailableError
+
+
+# Retries back off exponentially from ESI_BACKOFF_BASE up to ESI_BACKOFF_MAX
+# seconds, with full jitter so retries from an outage don't arrive together
+ESI_BACKOFF_BASE = getattr(local_settings, "ESI_BACKOFF_BASE", 10)
+ESI_BACKOFF_MAX = getattr(local_settings, "ESI_BACKOFF_MAX", 600)
 
 
 class APITask(Task):
@@ -32,6 +41,32 @@ class APITask(Task):
         "reversed": "Reversed"
     }
 
+    # ESI trouble puts the task back on the queue with a backoff instead of
+    # tying up this worker
+    def __call__(self, *args, **kwargs):
+        try:
+            return super(APITask, self).__call__(*args, **kwargs)
+        except ESIUnavailableError as exc:
+            countdown = self.backoff(self.request.retries)
+            if self.request.retries < local_settings.ESI_RETRIES:
+                self.retrying(countdown, *args, **kwargs)
+            raise self.retry(
+                exc=exc,
+                countdown=countdown,
+                max_retries=local_settings.ESI_RETRIES
+            )
+
+
+    def backoff(self, retries):
+        return random.uniform(0, min(ESI_BACKOFF_MAX, ESI_BACKOFF_BASE * 2 ** retries))
+
+
+    # Called with the task's arguments when it's about to be retried in
+    # countdown seconds
+    def retrying(self, countdown, *args, **kwargs):
+        pass
+
+
     def get_api(self, token_id):
         token = ESIToken.objects.get(id=token_id)
         return ESI(token)
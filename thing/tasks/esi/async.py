@@ -0,0 +1,261 @@
+import Queue
+
+from StringIO import StringIO
+
+from crochet import setup, run_in_reactor
+from django.db import connection
+from requests.structures import CaseInsensitiveDict
+from twisted.internet import defer, reactor, task, threads
+from twisted.web.client import Agent, HTTPConnectionPool, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+
+from .apitask import APITask
+from .characterinfo import ESI_CharacterInfo
+
+from evething import local_settings
+
+from thing.esi import ESI, ESIUnavailableError, ESI_CONNECT_TIMEOUT, ESI_READ_TIMEOUT
+from thing.esi_limits import error_limiter
+from thing.esi_scheduler import TokenLocked
+from thing.models import ESIToken
+
+
+# Requests in flight at once across every token in the batch
+ESI_ASYNC_CONCURRENCY = getattr(local_settings, "ESI_ASYNC_CONCURRENCY", 200)
+# Requests in flight at once to any one host
+ESI_ASYNC_PER_HOST = getattr(local_settings, "ESI_ASYNC_PER_HOST", 50)
+# Requests started per second, shared by every token in the batch
+ESI_ASYNC_RATE = getattr(local_settings, "ESI_ASYNC_RATE", 100)
+# Longest we wait for the next job in a batch to finish before giving up on
+# the rest of them
+ESI_ASYNC_STALL_TIME = getattr(local_settings, "ESI_ASYNC_STALL_TIME", 5 * 60)
+
+
+# Runs func on the reactor's thread pool. Like ESI._threaded_get() it closes
+# whatever database connection func opened, the pool's threads outlive it.
+def in_thread(func, *args, **kwargs):
+    return threads.deferToThread(closing_connection, func, *args, **kwargs)
+
+
+def closing_connection(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        connection.close()
+
+
+# Fetches ESI endpoints for many tokens at once on the Twisted reactor.
+# Cache lookups and storage go through the same ESI object the blocking
+# client uses, and anything that needs a token refresh or a retry after a
+# dropped connection is handed back to the blocking client on a thread.
+class ESIAsyncEngine(object):
+    def __init__(self, concurrency=ESI_ASYNC_CONCURRENCY, per_host=ESI_ASYNC_PER_HOST, rate=ESI_ASYNC_RATE):
+        setup()
+
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = per_host
+        self.agent = Agent(reactor, connectTimeout=ESI_CONNECT_TIMEOUT, pool=self.pool)
+
+        self.semaphore = defer.DeferredSemaphore(concurrency)
+        self.per_host = per_host
+        self.host_semaphores = {}
+
+        self.interval = 1.0 / rate
+        self.next_slot = 0
+
+
+    # Takes a list of (api, endpoints) jobs, endpoints being a get_many()
+    # style list. callback(api, results, error) is called from this thread as
+    # each job's endpoints have all arrived. As with get_many() an endpoint
+    # that failed has its exception in its place. If the whole job failed
+    # results is None and error is the exception that failed it.
+    # Blocks until every job has been handed over, jobs still running after
+    # ESI_ASYNC_STALL_TIME without any of them finishing fail with
+    # ESIUnavailableError.
+    def run(self, jobs, callback):
+        results = Queue.Queue()
+        # Raises anything _start() raised instead of leaving us waiting
+        self._start(jobs, results).wait(ESI_ASYNC_STALL_TIME)
+
+        waiting = set(id(api) for api, endpoints in jobs)
+        try:
+            while waiting:
+                try:
+                    api, responses, error = results.get(timeout=ESI_ASYNC_STALL_TIME)
+                except Queue.Empty:
+                    break
+                waiting.discard(id(api))
+                callback(api, responses, error)
+        finally:
+            self._stop()
+
+        for api, endpoints in jobs:
+            if id(api) in waiting:
+                callback(api, None, ESIUnavailableError("Gave up waiting for ESI"))
+
+
+    @run_in_reactor
+    def _start(self, jobs, results):
+        for api, endpoints in jobs:
+            d = defer.gatherResults(
+                [
+                    self._get(api, url, kwargs).addErrback(lambda failure: failure.value)
+                    for url, kwargs in api._calls(endpoints)
+                ],
+                consumeErrors=True
+            )
+            d.addCallbacks(
+                lambda responses, api=api: results.put((api, responses, None)),
+                lambda failure, api=api: results.put((api, None, failure.value.subFailure.value))
+            )
+
+
+    @run_in_reactor
+    def _stop(self):
+        return self.pool.closeCachedConnections()
+
+
+    # Fetches one endpoint, the cache work happens off the reactor thread
+    def _get(self, api, url, kwargs):
+        d = in_thread(api._prepare, url, **kwargs)
+
+        def fetch(call):
+            if call['cached']:
+                return call['result']
+
+            d = self.semaphore.run(self._host_semaphore(call['full_url']).run, self._fetch, api, call)
+            # Connection failures and timeouts get the blocking client's
+            # retries, anything finish() raises is the job's to deal with
+            d.addCallbacks(
+                finish,
+                lambda failure: threads.deferToThread(api._threaded_get, url, kwargs),
+                callbackArgs=(call,)
+            )
+            return d
+
+        def finish(response, call):
+            status_code, headers, text = response
+            in_thread(error_limiter.update, headers)
+
+            # Token refreshes are left to the blocking client, a 403 with a
+            # token that's good for a while yet is a real one
+            if status_code == 403 and api.token is not None and not api._token_fresh():
+                return threads.deferToThread(api._threaded_get, url, kwargs)
+
+            # ESI is struggling, the task retries the token later
+            if status_code == 420 or status_code >= 500:
+                return in_thread(api._unavailable, call, status_code, headers)
+
+            return in_thread(api._finish, call, status_code, headers, text)
+
+        d.addCallback(fetch)
+        return d
+
+
+    def _host_semaphore(self, url):
+        host = url.split("/")[2]
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = defer.DeferredSemaphore(self.per_host)
+        return self.host_semaphores[host]
+
+
+    # Waits for the next free slot under the shared rate limit
+    def _throttle(self):
+        now = reactor.seconds()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        return task.deferLater(reactor, slot - now, lambda: None)
+
+
+    # Waits for as long as the ESI error limiter says, without blocking the reactor
+    def _error_limit(self):
+        d = in_thread(error_limiter.delay)
+        d.addCallback(lambda delay: task.deferLater(reactor, min(delay, 60), lambda: None))
+        return d
+
+
+    def _fetch(self, api, call):
+        d = self._throttle()
+        d.addCallback(lambda _: self._error_limit())
+        d.addCallback(lambda _: self._send(api, call))
+        return d
+
+
+    def _send(self, api, call):
+        headers = api._bearer_header()
+        if call['etag'] is not None:
+            headers['If-None-Match'] = call['etag']['etag']
+
+        body = None
+        if call['data'] is not None:
+            body = FileBodyProducer(StringIO(call['data']))
+
+        d = self.agent.request(
+            call['method'],
+            call['full_url'],
+            Headers(dict((k, [v]) for k, v in headers.items())),
+            body
+        )
+        d.addCallback(self._read)
+
+        # Give up on requests that take too long
+        timeout = reactor.callLater(ESI_READ_TIMEOUT, d.cancel)
+
+        def cancel_timeout(result):
+            if timeout.active():
+                timeout.cancel()
+            return result
+
+        d.addBoth(cancel_timeout)
+        return d
+
+
+    def _read(self, response):
+        headers = CaseInsensitiveDict(
+            (k, v[-1]) for k, v in response.headers.getAllRawHeaders()
+        )
+        d = readBody(response)
+        d.addCallback(lambda body: (response.code, headers, body.decode("utf-8")))
+        return d
+
+
+# Syncs a batch of tokens with a single worker process. Every endpoint for
+# every token is fetched concurrently, then each character is written by the
+# regular ESI_CharacterInfo code as its data arrives.
+class ESI_AsyncCharacterSync(APITask):
+    name = "thing.esi.async_character_sync"
+
+
+    def run(self, token_ids):
+        tokens = ESIToken.objects.filter(id__in=token_ids, status=True)
+        jobs = [(ESI(token), ESI_CharacterInfo.endpoints) for token in tokens]
+
+        self.unavailable = []
+        ESIAsyncEngine().run(jobs, self.process)
+
+        # Try the tokens ESI let us down on again later, the rest are done
+        if self.unavailable and not self.request.called_directly:
+            raise self.retry(
+                args=[self.unavailable],
+                countdown=self.backoff(self.request.retries),
+                max_retries=local_settings.ESI_RETRIES
+            )
+
+
+    def process(self, api, results, error):
+        if results is None:
+            if isinstance(error, ESIUnavailableError):
+                self.unavailable.append(api.token.id)
+            else:
+                print "Failed to fetch ESI data for token id %s: %s" % (api.token.id, error)
+            return
+
+        try:
+            ESI_CharacterInfo().process(api, results)
+        except ESIUnavailableError:
+            self.unavailable.append(api.token.id)
+        except TokenLocked:
+            # Something else is syncing it right now
+            pass
+        except Exception as e:
+            print "Failed to update token id %s: %s" % (api.token.id, e)
@@ -1,11 +1,28 @@
+import random
+
+from collections import OrderedDict
 from datetime import datetime, timedelta
+from time import mktime, time
+
+from django.core.cache import cache
+from django.db.models import Count
 
 from .apitask import APITask
 
 from evething import local_settings
 
-from thing.models import ESIToken
-from thing.tasks.esi import ESI_CharacterInfo
+from thing.esi_scheduler import get_due_queue, ESI_USER_MAX_IN_FLIGHT
+from thing.models import ESIToken, ESITokenSection
+from thing.tasks.esi import ESI_CharacterInfo, ESI_CharacterSection, ESI_AsyncCharacterSync
+
+
+# Tokens per async sync task, 0 queues a task per due section instead
+ESI_ASYNC_BATCH_SIZE = getattr(local_settings, "ESI_ASYNC_BATCH_SIZE", 0)
+# Most sections handed out per run
+ESI_SCHEDULER_BATCH = getattr(local_settings, "ESI_SCHEDULER_BATCH", 5000)
+# How often every section in the database is checked against the due queue,
+# in case Redis lost some of it
+ESI_SCHEDULER_RESEED = getattr(local_settings, "ESI_SCHEDULER_RESEED", 60 * 60)
 
 
 class ESI_CharacterUpdateSpawner(APITask):
@@ -13,12 +30,100 @@ class ESI_CharacterUpdateSpawner(APITask):
 
 
     def run(self):
-        # Generate async update tasks for any ESI Token that hasn't been updated recently
+        if ESI_ASYNC_BATCH_SIZE > 0:
+            self.spawn_batches()
+        else:
+            self.spawn_sections()
+
+
+    # Queues a task for every section the due queue hands us
+    def spawn_sections(self):
+        queue = get_due_queue()
+        sections = ESI_CharacterInfo.sections
+
+        self.add_sections(queue)
+
+        if cache.add("esi:due:reseeded", 1, ESI_SCHEDULER_RESEED):
+            rows = ESITokenSection.objects.filter(
+                token__status=True,
+                name__in=sections.keys()
+            ).values_list('token_id', 'name', 'next_update')
+            queue.ensure([(token_id, name, mktime(next_update.timetuple())) for token_id, name, next_update in rows])
+
+        claimed = queue.claim(ESI_SCHEDULER_BATCH)
+
+        # Tokens that have been deleted or disabled since they were queued
+        # are dropped, the rest are grouped by user
+        users = dict(ESIToken.objects.filter(
+            id__in=set(token_id for token_id, name in claimed),
+            status=True
+        ).values_list('id', 'user_id'))
+
+        by_user = OrderedDict()
+        for token_id, name in claimed:
+            if token_id in users and name in sections:
+                by_user.setdefault(users[token_id], []).append((token_id, name))
+            else:
+                queue.remove(token_id, [name])
+
+        # Take turns between users so one with lots of characters can't fill
+        # the queue ahead of everyone else, and stop at each user's in flight
+        # limit. Whatever doesn't fit goes back to be claimed next time.
+        in_flight = queue.in_flight(by_user.keys())
+        queued = 0
+        while len(by_user) > 0:
+            for user_id in by_user.keys():
+                token_id, name = by_user[user_id].pop(0)
+                if in_flight[user_id] < ESI_USER_MAX_IN_FLIGHT:
+                    queue.start(user_id, token_id, name)
+                    ESI_CharacterSection().delay(token_id, name)
+                    in_flight[user_id] += 1
+                    queued += 1
+                else:
+                    queue.complete(token_id, name, time())
+
+                if len(by_user[user_id]) == 0:
+                    del by_user[user_id]
+
+        print "Queued %s of %s due section updates" % (queued, len(claimed))
+
+
+    # New tokens, or new sections, start out due at a random point within
+    # the section's shortest interval so they don't all land at once
+    def add_sections(self, queue):
+        now = time()
+        sections = ESI_CharacterInfo.sections
+
+        tokens = ESIToken.objects.filter(status=True).annotate(
+            section_count=Count('sections')
+        ).filter(
+            section_count__lt=len(sections)
+        )
+        for token in tokens:
+            existing = set(token.sections.values_list('name', flat=True))
+            rows = [
+                ESITokenSection(
+                    token=token,
+                    name=name,
+                    next_update=datetime.fromtimestamp(now + random.uniform(0, shortest))
+                )
+                for name, (endpoints, shortest, longest) in sections.items()
+                if name not in existing
+            ]
+            ESITokenSection.objects.bulk_create(rows)
+            queue.ensure([(token.id, row.name, mktime(row.next_update.timetuple())) for row in rows])
+
+
+    # Queues every token that hasn't been updated recently in batches for
+    # ESI_AsyncCharacterSync
+    def spawn_batches(self):
         tokens = ESIToken.objects.filter(
             status=True,
             last_updated__lte=datetime.now() - timedelta(minutes=local_settings.ESI_UPDATE_INTERVAL)
         )
-        for token in tokens:
-            ESI_CharacterInfo().delay(token.id)
-            print "Queued token update for token id %s" % token.id
-            token.save()
+        token_ids = list(tokens.values_list('id', flat=True))
+        for i in range(0, len(token_ids), ESI_ASYNC_BATCH_SIZE):
+            batch = token_ids[i:i + ESI_ASYNC_BATCH_SIZE]
+            ESI_AsyncCharacterSync().delay(batch)
+            print "Queued async update for %s tokens" % len(batch)
+        tokens.update(last_updated=datetime.now())
@@ -1,33 +1,312 @@
 import json
 
+from collections import OrderedDict
+from hashlib import sha256
 from datetime import datetime, timedelta
+from time import mktime
 
+from celery.exceptions import SoftTimeLimitExceeded
 from django import db
-from django.db.models import Sum, F, FloatField, Q
+from django.core.cache import cache
+from django.db.models import Sum, Max, F, FloatField, Q
 
 from .apitask import APITask
 from .mail_fetch_task import ESI_MailFetchTask
 
+from evething import local_settings
+
 from thing.esi_enums import *
-from thing.esi import ESI
+from thing.esi import ESI, ESIUnavailableError
+from thing.esi_assets import AssetTree
+from thing.esi_resolver import EntityResolver, ESI_BULK_SIZE
+from thing.esi_scheduler import get_due_queue, TokenLock, TokenLocked, ESI_SECTION_LEASE
+from thing.esi_sync import sync_rows
 from thing.models import *
-
-# This task effectively replaces the characterInfo and characterSheet calls
+from thing import queries
+
+
+# Each section of a character's data, with the endpoints it needs and the
+# shortest and longest time in seconds between refreshes. Within those bounds
+# a section is due again as soon as one of its endpoints' ESI cache timers
+# runs out. Only the first page of paginated endpoints is listed here, the
+# sections fetch the rest with get_pages()/iter_pages().
+SECTIONS = OrderedDict([
+    ("character", ([
+        "/v4/characters/$id/",
+        "/v1/characters/$id/attributes/",
+        "/v1/characters/$id/fatigue/"
+    ], 5 * 60, 6 * 60 * 60)),
+    ("location", ([
+        "/v1/characters/$id/location/",
+        "/v1/characters/$id/ship/"
+    ], 5, 60 * 60)),
+    ("wallet", (["/v1/characters/$id/wallet/"], 60, 60 * 60)),
+    ("journal", (["/v4/characters/$id/wallet/journal/"], 5 * 60, 6 * 60 * 60)),
+    ("clones", (["/v3/characters/$id/clones/"], 5 * 60, 24 * 60 * 60)),
+    ("implants", (["/v1/characters/$id/implants/"], 5 * 60, 24 * 60 * 60)),
+    ("skills", ([
+        ("/v4/characters/$id/skills/", {"conditional": True}),
+        ("/v2/characters/$id/skillqueue/", {"conditional": True})
+    ], 5 * 60, 6 * 60 * 60)),
+    ("assets", (["/v3/characters/$id/assets/"], 30 * 60, 24 * 60 * 60)),
+    ("standings", ([("/v1/characters/$id/standings/", {"conditional": True})], 60 * 60, 24 * 60 * 60)),
+    ("industry", (["/v1/characters/$id/industry/jobs/"], 5 * 60, 6 * 60 * 60)),
+    ("orders", (["/v1/characters/$id/orders/"], 5 * 60, 6 * 60 * 60)),
+    ("mail", (["/v1/characters/$id/mail/"], 30, 60 * 60)),
+    ("planets", (["/v1/characters/$id/planets/"], 10 * 60, 24 * 60 * 60)),
+    ("contracts", (["/v1/characters/$id/contracts/"], 5 * 60, 24 * 60 * 60))
+])
+
+# Sections are synced less often the longer their user has been away, one
+# step per ESI_SYNC_ACTIVE_DAYS up to ESI_SYNC_MAX_BACKOFF times less often,
+# but still within the section's longest interval
+ESI_SYNC_ACTIVE_DAYS = getattr(local_settings, "ESI_SYNC_ACTIVE_DAYS", 2)
+ESI_SYNC_MAX_BACKOFF = getattr(local_settings, "ESI_SYNC_MAX_BACKOFF", 12)
+# Every sync that finds a section unchanged stretches its interval by this
+# much, up to the section's longest interval
+ESI_SYNC_UNCHANGED_BACKOFF = getattr(local_settings, "ESI_SYNC_UNCHANGED_BACKOFF", 1.5)
+
+# How long to wait before trying a token that's already being synced again
+ESI_SYNC_LOCK_RETRY = getattr(local_settings, "ESI_SYNC_LOCK_RETRY", 15)
+# How long a run's finished sections are remembered for its retries
+ESI_CHECKPOINT_TIME = getattr(local_settings, "ESI_CHECKPOINT_TIME", 60 * 60)
+# How long to wait before trying a section that failed again, within its
+# shortest and longest intervals
+ESI_SYNC_FAILURE_DELAY = getattr(local_settings, "ESI_SYNC_FAILURE_DELAY", 30 * 60)
+# How long a queued mail fetch keeps its mail from being queued again
+ESI_MAIL_QUEUED_TIME = getattr(local_settings, "ESI_MAIL_QUEUED_TIME", 10 * 60)
+
+# Sections that keep moving while a character has jobs or orders running.
+# They stay on ESI's cache timer for busy characters, however quiet they look.
+BUSY_SECTIONS = ["industry", "orders", "wallet", "journal"]
+
+
+# This task effectively replaces the characterInfo and characterSheet calls.
+# It syncs every section of a character at once, ESI_CharacterSection syncs
+# them one at a time.
 class ESI_CharacterInfo(APITask):
     name = "thing.esi.character_info"
     api = None
 
+    sections = SECTIONS
+
+    # Every section's endpoints, in the order process() takes them
+    endpoints = [endpoint for section in SECTIONS.values() for endpoint in section[0]]
+
+    # Retries of this task (ESI trouble, the token being busy, running out
+    # of time) pick up after the last section that was finished. Direct
+    # calls aren't retried, so they don't keep a checkpoint.
     def run(self, token_id):
-        self.api = self.get_api(token_id)
+        api = self.get_api(token_id)
+        self.activity = {}
 
-        ## Character Data
+        checkpoint = None
+        done = []
+        if self.request.id is not None:
+            checkpoint = "esi:checkpoint:%s" % self.request.id
+            done = json.loads(cache.get(checkpoint) or "[]")
+        sections = [name for name in self.sections.keys() if name not in done]
+
+        try:
+            # Fetch while holding the lock, so an overlapping sync can't
+            # fetch the same responses and find them unchanged
+            with TokenLock(token_id):
+                # Every independent section in one concurrent round
+                endpoints = [endpoint for name in sections for endpoint in self.sections[name][0]]
+                self.process_sections(api, api.get_many(endpoints), sections, checkpoint)
+        except (TokenLocked, SoftTimeLimitExceeded) as exc:
+            raise self.retry(exc=exc, countdown=ESI_SYNC_LOCK_RETRY, max_retries=local_settings.ESI_RETRIES)
+
+        if checkpoint is not None:
+            cache.delete(checkpoint)
+
+
+    # Takes the token's lock and writes a set of endpoints fetched without
+    # it, see process_sections()
+    def process(self, api, results, sections=None, checkpoint=None):
+        with TokenLock(api.token.id):
+            self.process_sections(api, results, sections, checkpoint)
+
+
+    # Writes a set of fetched endpoints to the database, for every section
+    # or the given ones. A section that fails doesn't stop the rest, but if
+    # ESI was the problem the task is retried once they're done. Sections
+    # that ran are added to the checkpoint key if there is one. The caller
+    # holds the token's lock.
+    def process_sections(self, api, results, sections=None, checkpoint=None):
+        self.api = api
+        self.activity = {}
+        unavailable = None
+
+        if sections is None:
+            sections = self.sections.keys()
+
+        done = []
+        if checkpoint is not None:
+            done = json.loads(cache.get(checkpoint) or "[]")
+
+        for name in sections:
+            endpoints = self.sections[name][0]
+            section_results, results = results[:len(endpoints)], results[len(endpoints):]
+            try:
+                processed = self.process_section(name, section_results)
+            except ESIUnavailableError as e:
+                unavailable = e
+                continue
+            except SoftTimeLimitExceeded:
+                raise
+            except Exception as e:
+                print "Failed to update %s for token id %s: %s" % (name, api.token.id, e)
+                continue
+
+            # Sections waiting on the character haven't run, a retry does them
+            if checkpoint is not None and processed:
+                done.append(name)
+                cache.set(checkpoint, json.dumps(done), ESI_CHECKPOINT_TIME)
+
+        if unavailable is not None:
+            raise unavailable
+
+        print "Finished updating token id %s" % api.token.id
+
+
+    # Writes one section's results and works out when it's next due. Returns
+    # False if the section couldn't run yet.
+    def process_section(self, name, results):
+        # An endpoint that failed leaves its exception in its place
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+        # Everything hangs off the character, which its own section creates
+        character = Character.objects.select_related('corporation').filter(pk=self.api.token.characterID).first()
+        if character is None and name != "character":
+            return False
+
+        row = ESITokenSection.objects.filter(token=self.api.token, name=name).first()
+        checksum = self.checksum(results)
+
+        getattr(self, "section_%s" % name)(character, *results)
+
+        # Keep track of how long it's been since the section last changed
+        now = datetime.now()
+        if checksum is None or (row is not None and row.checksum == checksum):
+            unchanged_runs = row.unchanged_runs + 1 if row is not None else 1
+            self.schedule(
+                name,
+                self.next_update(name, character, unchanged_runs),
+                last_updated=now,
+                unchanged_runs=unchanged_runs
+            )
+        else:
+            self.schedule(
+                name,
+                self.next_update(name, character),
+                last_updated=now,
+                last_changed=now,
+                unchanged_runs=0,
+                checksum=checksum
+            )
+
+        # Only now has the section seen what ESI sent
+        for url, kwargs in self.api._calls(self.sections[name][0]):
+            self.api.commit_etag(url, kwargs.get("get_vars", {}))
+        return True
+
+
+    # Fingerprint of a section's results, None if ESI told us nothing changed
+    def checksum(self, results):
+        if ESI.NOT_MODIFIED in results:
+            return None
+        return sha256(json.dumps(results, sort_keys=True)).hexdigest()
+
+
+    # Records when a section is next due, in the database and the due queue
+    def schedule(self, name, next_update, **fields):
+        fields['next_update'] = next_update
+        ESITokenSection.objects.update_or_create(token=self.api.token, name=name, defaults=fields)
+        get_due_queue().complete(self.api.token.id, name, mktime(next_update.timetuple()))
+
+
+    # When a section should next be synced. That's when the responses we just
+    # got go stale, held back the longer the section goes without changing
+    # and the longer the user goes without looking at it.
+    def next_update(self, name, character=None, unchanged_runs=0):
+        endpoints, shortest, longest = self.sections[name]
+
+        expiries = [
+            self.api.expires(url, kwargs.get("get_vars", {}))
+            for url, kwargs in self.api._calls(endpoints)
+        ]
+        expiries = [expiry for expiry in expiries if expiry is not None]
+
+        now = datetime.now()
+        if len(expiries) > 0:
+            interval = (min(expiries) - now).total_seconds()
+        else:
+            interval = longest
+        interval = min(max(interval, shortest), longest)
+
+        busy = name in BUSY_SECTIONS and character is not None and self.is_busy(character)
+        if not busy:
+            # Never past the section's longest interval, however dormant
+            interval *= ESI_SYNC_UNCHANGED_BACKOFF ** unchanged_runs * self.activity_factor()
+            interval = min(interval, longest)
+
+        next_update = now + timedelta(seconds=interval)
+
+        # Catch industry jobs as they finish
+        if name == "industry" and character is not None:
+            next_job = IndustryJob.objects.filter(
+                character=character,
+                status=IndustryJob.ACTIVE_STATUS,
+                end_date__gt=datetime.utcnow()
+            ).order_by('end_date').values_list('end_date', flat=True).first()
+            if next_job is not None:
+                next_update = min(next_update, now + (next_job - datetime.utcnow()) + timedelta(seconds=shortest))
+
+        return next_update
+
+
+    # How many times less often to sync this token, going by when its user
+    # was last seen
+    def activity_factor(self):
+        if "factor" not in self.activity:
+            last_seen = UserProfile.objects.filter(user=self.api.token.user_id).values_list('last_seen', flat=True).first()
+            if last_seen is None:
+                self.activity['factor'] = ESI_SYNC_MAX_BACKOFF
+            else:
+                idle_days = (datetime.utcnow() - last_seen).total_seconds() / (24 * 60 * 60)
+                self.activity['factor'] = min(ESI_SYNC_MAX_BACKOFF, max(1, idle_days / ESI_SYNC_ACTIVE_DAYS))
+        return self.activity['factor']
+
+
+    # Whether the character has industry jobs or market orders running
+    def is_busy(self, character):
+        if "busy" not in self.activity:
+            self.activity['busy'] = (
+                IndustryJob.objects.filter(character=character, status=IndustryJob.ACTIVE_STATUS).exists() or
+                MarketOrder.objects.filter(character=character, volume_remaining__gt=0).exists()
+            )
+        return self.activity['busy']
+
+
+    # Syncs rows with sync_rows() and logs what changed
+    def sync(self, label, queryset, key, rows, fields, delete=True):
+        counts = sync_rows(queryset, key, rows, fields, delete=delete)
+        if any(counts.values()):
+            print "Synced %s for token id %s: %s created, %s updated, %s deleted" % (
+                label, self.api.token.id, counts['created'], counts['updated'], counts['deleted']
+            )
+        return counts
+
+
+    ## Character Data
+    def section_character(self, character, public, attributes, fatigue):
         characterID = self.api.token.characterID
-        public = self.api.get("/v4/characters/$id/")
 
         # Get or create character object
-        try:
-            character = Character.objects.select_related('config', 'corporation', 'details').get(pk=characterID)
-        except Character.DoesNotExist:
+        if character is None:
             character = Character()
             character.id = characterID
         character.name = public['name']
@@ -44,19 +323,8 @@ class ESI_CharacterInfo(APITask):
         except CharacterDetails.DoesNotExist:
             charDetails = CharacterDetails(character=character)
 
-
-        # Perform the rest of the calls
         with db.transaction.atomic():
-            location = self.api.get("/v1/characters/$id/location/")
-            ship = self.api.get("/v1/characters/$id/ship/")
-            wallet = self.api.get("/v1/characters/$id/wallet/")
-
-            # Populate the database
-            charDetails.wallet_balance = float(wallet)
-            charDetails.plex_balance = 0
-
             # Get character attributes
-            attributes = self.api.get("/v1/characters/$id/attributes/")
             charDetails.cha_attribute = attributes['charisma']
             charDetails.int_attribute = attributes['intelligence']
             charDetails.mem_attribute = attributes['memory']
@@ -64,20 +332,124 @@ class ESI_CharacterInfo(APITask):
             charDetails.wil_attribute = attributes['willpower']
 
             charDetails.security_status = public['security_status']
-            charDetails.last_known_location = self.last_known_location(location)
-            charDetails.ship_name = ship['ship_name']
-            charDetails.ship_item = Item.objects.get(id=ship['ship_type_id'])
+
+            ## Fatigue
+            try:
+                charDetails.last_jump_date = self.parse_api_date(fatigue['last_jump_date'])
+                charDetails.fatigue_expire_date = self.parse_api_date(fatigue['jump_fatigue_expire_date'])
+            except Exception:
+                # This character hasn't been re-added since 24/08/17
+                pass
 
             # Save
             character.save()
-            charDetails.save()
+            if charDetails.pk is None:
+                charDetails.save()
+            else:
+                charDetails.save(update_fields=[
+                    'cha_attribute', 'int_attribute', 'mem_attribute', 'per_attribute', 'wil_attribute',
+                    'security_status', 'last_jump_date', 'fatigue_expire_date'
+                ])
             charConfig.save()
+
+            # If we reach this far the token is active again
             self.api.token.character = character
+            self.api.token.status = True
             self.api.token.save()
 
-        # Clones
+
+    ## Location and ship
+    def section_location(self, character, location, ship):
+        CharacterDetails.objects.filter(character=character).update(
+            last_known_location=self.last_known_location(location),
+            ship_name=ship['ship_name'],
+            ship_item=Item.objects.get(id=ship['ship_type_id'])
+        )
+
+
+    ## Wallet
+    def section_wallet(self, character, wallet):
+        CharacterDetails.objects.filter(character=character).update(
+            wallet_balance=float(wallet),
+            plex_balance=0
+        )
+
+
+    ## Wallet Journal
+    def section_journal(self, character, journal):
+        # Newest entries come first, so once a page reaches entries we already
+        # have there's nothing new further back
+        high_water = JournalEntry.objects.filter(character=character).aggregate(Max('ref_id'))['ref_id__max'] or 0
+
+        entries = []
+        for page in self.api.walk_pages("/v4/characters/$id/wallet/journal/"):
+            entries.extend(page)
+            if len(page) == 0 or min(entry['id'] for entry in page) <= high_water:
+                break
+
+        if len(entries) == 0:
+            return
+
+        # Entries don't always arrive in ref_id order, so the ones we have are
+        # looked up rather than assumed from the high-water mark
+        known = set(JournalEntry.objects.filter(
+            character=character,
+            ref_id__gte=min(entry['id'] for entry in entries)
+        ).values_list('ref_id', flat=True))
+
+        new_entries = []
+        for entry in entries:
+            if entry['id'] in known:
+                continue
+            known.add(entry['id'])
+
+            db_entry = JournalEntry(
+                character=character,
+                date=self.parse_api_date(entry['date']),
+                ref_id=entry['id'],
+                ref_type=entry['ref_type']
+            )
+
+            if db_entry.ref_type == "insurance":
+                db_entry.owner1_id = character.id
+                db_entry.owner2_id = 1000132
+                if "extra_info" in entry:
+                    db_entry.arg_name = entry['extra_info']['destroyed_ship_type_id']
+            else:
+                if "first_party_id" in entry:
+                    db_entry.owner1_id = entry['first_party_id']
+                if "second_party_id" in entry:
+                    db_entry.owner2_id = entry['second_party_id']
+
+            db_entry.amount = entry['amount']
+            db_entry.balance = entry['balance']
+            if "reason" in entry:
+                db_entry.reason = entry['reason']
+
+            new_entries.append(db_entry)
+
+        if len(new_entries) == 0:
+            return
+
+        try:
+            with db.transaction.atomic():
+                JournalEntry.objects.bulk_create(new_entries)
+        except db.IntegrityError:
+            # Another sync of this character got some of them in first
+            known = set(JournalEntry.objects.filter(
+                character=character,
+                ref_id__in=[e.ref_id for e in new_entries]
+            ).values_list('ref_id', flat=True))
+            with db.transaction.atomic():
+                JournalEntry.objects.bulk_create([e for e in new_entries if e.ref_id not in known])
+
+
+    ## Clones
+    def section_clones(self, character, clones):
+        if "jump_clones" in clones:
+            Station.prefetch([c['location_id'] for c in clones['jump_clones']])
+
         with db.transaction.atomic():
-            clones = self.api.get("/v3/characters/$id/clones/")
             # Delete existing clones
             Clone.objects.filter(character=character).delete()
             if "jump_clones" in clones:
@@ -98,492 +470,507 @@ class ESI_CharacterInfo(APITask):
                             )
                             db_implant.save()
 
-        # Wallet Journal
-        with db.transaction.atomic():
-            journal = self.api.get("/v4/characters/$id/wallet/journal/")
-            for entry in journal:
-                db_entry = JournalEntry.objects.filter(character=character, ref_id=entry['id'])
-                if len(db_entry) == 0:
-                    db_entry = JournalEntry(
-                        character=character,
-                        date=self.parse_api_date(entry['date']),
-                        ref_id=entry['id'],
-                        ref_type=entry['ref_type']
-                    )
-
-                    if db_entry.ref_type == "insurance":
-                        db_entry.owner1_id = character.id
-                        db_entry.owner2_id = 1000132
-                        if "extra_info" in entry:
-                            db_entry.arg_name = entry['extra_info']['destroyed_ship_type_id']
-                    else:
-                        if "first_party_id" in entry:
-                            db_entry.owner1_id = entry['first_party_id']
-                        if "second_party_id" in entry:
-                            db_entry.owner2_id = entry['second_party_id']
-
-                    db_entry.amount = entry['amount']
-                    db_entry.balance = entry['balance']
-                    if "reason" in entry:
-                        db_entry.reason = entry['reason']
 
-                    db_entry.save()
+    ## Implants
+    def section_implants(self, character, implants):
+        charDetails = CharacterDetails.objects.filter(character=character).first()
+        if charDetails is None:
+            return
 
-
-        ## Skills
         with db.transaction.atomic():
-            skills = self.api.get("/v4/characters/$id/skills/")
-            for skill in skills['skills']:
-                db_skill = CharacterSkill.objects.filter(character=character, skill_id=skill['skill_id'])
-                if len(db_skill) == 1:
-                    db_skill = db_skill[0]
-                else:
-                    db_skill = CharacterSkill(character=character, skill_id=skill['skill_id'])
-
-                db_skill.level = skill['trained_skill_level']
-                db_skill.points = skill['skillpoints_in_skill']
-                db_skill.save()
-
-            queue = self.api.get("/v2/characters/$id/skillqueue/")
-            # Remove all skills
-            SkillQueue.objects.filter(character=character).delete()
             try:
-                for skill in queue:
-                        db_skill = SkillQueue(character=character, skill_id=skill['skill_id'], to_level=skill['finished_level'])
-                        db_skill.start_time = self.parse_api_date(skill['start_date'])
-                        db_skill.end_time = self.parse_api_date(skill['finish_date'])
-                        db_skill.start_sp = skill['training_start_sp']
-                        db_skill.end_sp = skill['level_end_sp']
-                        db_skill.to_level = skill['finished_level']
-                        db_skill.save()
-
-            except KeyError:
-                # This character isn't training, wipe the queue
-                SkillQueue.objects.filter(character=character).delete()
+                charDetails.implants.clear()
+                for implant in implants:
+                    charDetails.implants.add(implant)
+
+            except Exception:
+                # This character hasn't been re-added since 24/08/17
+                pass
 
 
-        ## Assets
+    ## Skills
+    def section_skills(self, character, skills, queue):
         with db.transaction.atomic():
-            assets = self.api.get("/v3/characters/$id/assets/")
-            asset_map = map(lambda x: x['item_id'], assets)
+            if skills is not ESI.NOT_MODIFIED:
+                existing = dict(
+                    (skill_id, (id, level, points))
+                    for id, skill_id, level, points in CharacterSkill.objects.filter(
+                        character=character
+                    ).values_list('id', 'skill_id', 'level', 'points')
+                )
 
-            for asset in assets:
-                db_asset = Asset.objects.filter(asset_id=asset['item_id'])
-                if len(db_asset) == 1:
-                    db_asset = db_asset[0]
-                else:
-                    db_asset = Asset(character=character, asset_id=asset['item_id'], item_id=asset['type_id'])
+                new_skills = []
+                # (level, points): ids of the rows that need them, most
+                # changes share a level so this is a handful of UPDATEs
+                changed = {}
+                for skill in skills['skills']:
+                    level = skill['trained_skill_level']
+                    points = skill['skillpoints_in_skill']
 
-                db_asset.inv_flag_id = PersonalLocationFlagEnum[asset['location_flag']].value
+                    if skill['skill_id'] not in existing:
+                        new_skills.append(CharacterSkill(
+                            character=character,
+                            skill_id=skill['skill_id'],
+                            level=level,
+                            points=points
+                        ))
+                        continue
 
-                db_asset.singleton = asset['is_singleton']
-                if asset['is_singleton']:
-                    db_asset.quantity = 1
-                    db_asset.raw_quantity = -1
-                else:
-                    db_asset.quantity = asset['quantity']
-                    db_asset.raw_quantity = 0
-
-                # Calculate parent and location
-                # Try asset
-                if asset['location_id'] in asset_map:
-                    db_asset.parent = asset['location_id']
-                    db_asset.station = None
-                    db_asset.system = None
-                    db_asset.save()
-                    continue
-                # Try station
-                if Station.get_or_create(asset['location_id'], self.api) != None:
-                    station = Station.objects.get(id=asset['location_id'])
-                    db_asset.station = station
-                    db_asset.system_id = station.system_id
-                    db_asset.save()
-                    continue
-                # Try solar system
-                if System.objects.filter(id=asset['location_id']).count() > 0:
-                    db_asset.station = None
-                    db_asset.system_id = asset['location_id']
-                    db_asset.save()
-                    continue
+                    id, old_level, old_points = existing[skill['skill_id']]
+                    if (old_level, old_points) != (level, points):
+                        changed.setdefault((level, points), []).append(id)
 
-            # Fix station/system values for parented assets
-            def resolve_location(asset):
-                if asset.station == None:
-                    #print "%s/%s" % (asset.parent, asset.asset_id)
-                    parent = Asset.objects.get(asset_id=asset.parent)
-                    if parent.station_id != None:
-                        asset.station_id = parent.station_id
-                        asset.system_id = parent.system_id
-                        asset.save()
-                        return (parent.station_id, parent.system_id)
-                    else:
-                        station_id, system_id = resolve_location()
-                        asset.station_id = station_id
-                        asset.system_id = system_id
-                        asset.save()
-                        return (station_id, system_id)
-                else:
-                    return None
+                CharacterSkill.objects.bulk_create(new_skills)
+                for (level, points), ids in changed.items():
+                    CharacterSkill.objects.filter(id__in=ids).update(level=level, points=points)
 
-            for asset in Asset.objects.filter(character=character, station=None):
+            if queue is not ESI.NOT_MODIFIED:
                 try:
-                    resolve_location(asset)
-                except Exception:
-                    pass
-
-            # Delete all assets not in the map
-            Asset.objects.filter(character=character).exclude(asset_id__in=asset_map).delete()
-
-            # Fetch names for all ships/containers
-            items = list(Asset.objects.filter(
-                Q(character=character),
-                Q(item__item_group__category_id=6) | Q(item__item_group__in=[12 , 340, 448])
-            ).values_list(
-                'asset_id',
-                flat=True
-            ))
-            asset_names = self.api.post("/v1/characters/$id/assets/names/", data=json.dumps(items))
-            for asset in asset_names:
-                db_asset = Asset.objects.get(asset_id=asset['item_id'])
-                db_asset.name = asset['name']
-                db_asset.save()
-
-            # Rebuild asset summary
-            AssetSummary.objects.filter(character=character).delete()
-            summaries = Asset.objects.raw('''
-                SELECT
-                    thing_station.id as id,
-                	thing_station.id as station_id,
-                    thing_station.system_id as system_id,
-                    SUM(thing_asset.quantity) as total_items,
-                    SUM(thing_asset.quantity * thing_item.volume) as total_volume,
-                    SUM(thing_asset.quantity * thing_item.sell_price) as total_value
-                FROM thing_asset
-                INNER JOIN thing_station ON thing_station.id = thing_asset.station_id
-                INNER JOIN thing_item ON thing_item.id = thing_asset.item_id
-                WHERE thing_asset.character_id = %s
-                GROUP BY thing_station.id
-                ORDER BY thing_station.name
-                ''', [character.id])
-
-            for summary in summaries:
-                db_summary = AssetSummary(
-                    character=character,
-                    system_id=summary.system_id,
-                    station_id=summary.id,
-                    total_items=summary.total_items,
-                    total_volume=summary.total_volume,
-                    total_value=summary.total_value
-                )
-                db_summary.save()
-
-
-        ## Standings
-        with db.transaction.atomic():
-            standings = self.api.get("/v1/characters/$id/standings/")
-            factions = filter(lambda x: x['from_type'] == "faction", standings)
-            for faction in factions:
-                factionstanding = FactionStanding.objects.filter(character=character, faction_id=faction['from_id'])
-                if len(factionstanding) == 1:
-                    factionstanding = factionstanding[0]
-                else:
-                    factionstanding = FactionStanding(character=character, faction_id=faction['from_id'])
-
-                factionstanding.standing = faction['standing']
-                factionstanding.save()
+                    new_queue = [
+                        SkillQueue(
+                            character=character,
+                            skill_id=skill['skill_id'],
+                            start_time=self.parse_api_date(skill['start_date']),
+                            end_time=self.parse_api_date(skill['finish_date']),
+                            start_sp=skill['training_start_sp'],
+                            end_sp=skill['level_end_sp'],
+                            to_level=skill['finished_level']
+                        )
+                        for skill in queue
+                    ]
+                except KeyError:
+                    # This character isn't training, wipe the queue
+                    new_queue = []
 
-            npc_corps = filter(lambda x: x['from_type'] == "npc_corp", standings)
-            for npc_corp in npc_corps:
-                corpstanding = CorporationStanding.objects.filter(character=character, corporation_id=npc_corp['from_id'])
-                if len(corpstanding) == 1:
-                    corpstanding = corpstanding[0]
-                else:
-                    corpstanding = CorporationStanding(character=character, corporation_id=npc_corp['from_id'])
+                SkillQueue.objects.filter(character=character).delete()
+                SkillQueue.objects.bulk_create(new_queue)
+
+
+    ## Assets
+    def section_assets(self, character, assets):
+        assets = self.api.get_pages("/v3/characters/$id/assets/", conditional=True)
+        if assets is not ESI.NOT_MODIFIED:
+            self.write_assets(character, assets)
+
+        # Fetch names for the assembled ships and containers that don't have
+        # one yet, only they can be named. Names that couldn't be fetched
+        # last time are asked for again even if nothing has moved.
+        items = list(Asset.objects.filter(
+            Q(character=character),
+            Q(singleton=True),
+            Q(name=''),
+            Q(item__item_group__category_id=6) | Q(item__item_group__in=[12 , 340, 448])
+        ).values_list(
+            'asset_id',
+            flat=True
+        ))
+        self.save_asset_names(character, self.asset_names(items))
+
+
+    # Brings a character's assets and asset summary in line with the list
+    # ESI sent
+    def write_assets(self, character, assets):
+        tree = AssetTree(assets)
+        locations = self.asset_locations(tree.roots())
+
+        # The columns an asset is compared on, in values_list() order
+        fields = ('parent', 'system', 'station', 'item', 'inv_flag', 'quantity', 'raw_quantity', 'singleton')
+        existing = dict(
+            (row[0], (row[1], row[2], row[3:]))
+            for row in Asset.objects.filter(character=character).values_list('asset_id', 'id', 'name', *fields)
+        )
+
+        new_assets = []
+        # Rows that changed are deleted and created again, there's no
+        # bulk_update and nothing refers to an asset by its id
+        stale_ids = []
+        for asset in tree.assets():
+            root = tree.root(asset)
+            if root not in locations:
+                # Somewhere we can't place, leave what we had alone
+                continue
+            station_id, system_id = locations[root]
+
+            if asset['is_singleton']:
+                quantity, raw_quantity = 1, -1
+            else:
+                quantity, raw_quantity = asset['quantity'], 0
+
+            values = (
+                tree.parent(asset),
+                system_id,
+                station_id,
+                asset['type_id'],
+                PersonalLocationFlagEnum[asset['location_flag']].value,
+                quantity,
+                raw_quantity,
+                asset['is_singleton']
+            )
+            parent, system_id, station_id, item_id, inv_flag_id, quantity, raw_quantity, singleton = values
+
+            name = ''
+            if asset['item_id'] in existing:
+                id, name, old_values = existing[asset['item_id']]
+                if old_values == values:
+                    continue
+                stale_ids.append(id)
+
+                # Repackaging loses the name, assembling it again needs a
+                # fresh one
+                if old_values[-1] != singleton:
+                    name = ''
+
+            new_assets.append(Asset(
+                character=character,
+                asset_id=asset['item_id'],
+                name=name,
+                parent=parent,
+                system_id=system_id,
+                station_id=station_id,
+                item_id=item_id,
+                inv_flag_id=inv_flag_id,
+                quantity=quantity,
+                raw_quantity=raw_quantity,
+                singleton=singleton
+            ))
 
-                corpstanding.standing = npc_corp['standing']
-                corpstanding.save()
+        gone_ids = [id for asset_id, (id, name, old_values) in existing.items() if asset_id not in tree.items]
 
+        if len(new_assets) + len(gone_ids) > 0:
+            # Readers see the old assets and summary until both are replaced
+            with db.transaction.atomic():
+                if len(stale_ids) + len(gone_ids) > 0:
+                    Asset.objects.filter(id__in=stale_ids + gone_ids).delete()
+                Asset.objects.bulk_create(new_assets, batch_size=1000)
+
+                AssetSummary.objects.filter(character=character, corporation_id=0).delete()
+                db.connection.cursor().execute(queries.asset_summary, [character.id])
+
+
+    # Where each outermost location of an asset tree is, as
+    # {location_id: (station_id, system_id)}. Locations that are neither a
+    # station, a structure we can see nor a system are left out.
+    def asset_locations(self, location_ids):
+        systems = set(System.objects.filter(id__in=location_ids).values_list('id', flat=True))
+        Station.prefetch([id for id in location_ids if id not in systems])
+
+        locations = {}
+        for location_id in location_ids:
+            if location_id in systems:
+                locations[location_id] = (None, location_id)
+                continue
+
+            station = Station.get_or_create(location_id, self.api)
+            if station is not None:
+                locations[location_id] = (station.id, station.system_id)
+
+        return locations
+
+
+    # Returns {item_id: name} for the given assets. ESI takes at most
+    # ESI_BULK_SIZE IDs per call, so they're asked for in concurrent chunks.
+    # Chunks that fail are tried again on the next sync.
+    def asset_names(self, item_ids):
+        chunks = [item_ids[i:i + ESI_BULK_SIZE] for i in range(0, len(item_ids), ESI_BULK_SIZE)]
+        results = self.api.post_many("/v1/characters/$id/assets/names/", [json.dumps(chunk) for chunk in chunks])
+
+        names = {}
+        for result in results:
+            for asset in result or []:
+                names[asset['item_id']] = asset['name'][:128]
+        return names
+
+
+    # Writes {item_id: name} to a character's assets, one UPDATE per chunk
+    def save_asset_names(self, character, names):
+        names = names.items()
+        cursor = db.connection.cursor()
+        for i in range(0, len(names), ESI_BULK_SIZE):
+            chunk = names[i:i + ESI_BULK_SIZE]
+            cursor.execute(
+                queries.asset_names % (
+                    " ".join(["WHEN %s THEN %s"] * len(chunk)),
+                    ", ".join(["%s"] * len(chunk))
+                ),
+                [value for pair in chunk for value in pair] + [character.id] + [item_id for item_id, name in chunk]
+            )
+
+
+    ## Standings
+    def section_standings(self, character, standings):
+        if standings is ESI.NOT_MODIFIED:
+            return
 
-        ## Industry
         with db.transaction.atomic():
-            jobs = self.api.get("/v1/characters/$id/industry/jobs/")
-            for job in jobs:
-                db_job = IndustryJob.objects.filter(job_id=job['job_id'])
-                if len(db_job) == 1:
-                    db_job = db_job[0]
-                else:
-                    db_job = IndustryJob(
-                        job_id=job['job_id'],
-                        installer_id=job['installer_id'],
-                        activity=job['activity_id'],
-                        output_location_id=job['output_location_id'],
-                        runs=job['runs'],
-                        team_id=0,  # This doesn't exist anymore so it's not in ESI
-                        licensed_runs=job['licensed_runs'],
-                        duration=job['duration'],
-                        start_date=self.parse_api_date(job['start_date']),
-                        end_date=self.parse_api_date(job['end_date']),
-                        pause_date=datetime(0001, 1, 1, 1, 0),
-                        completed_date=datetime(0001, 1, 1, 1, 0),
-                        blueprint_id=job['blueprint_type_id'],
-                        character=character,
-                        corporation=None,
-                        product_id=job['product_type_id'],
-
-                        # POSes are getting removed soon so we're just going to
-                        # assume the facility is a station/structure
-                        system_id=Station.get_or_create(job['facility_id'], self.api).system_id
-                    )
-
-                # Update other values
-                db_job.status = IndustryJobStatusEnum[job['status']].value
-
-                if "completed_date" in job:
-                    db_job.completed_date = self.parse_api_date(job['completed_date'])
-                if "pause_date" in job:
-                    db_job.pause_date = self.parse_api_date(job['pause_date'])
-
-                db_job.save()
+            self.sync(
+                "faction standings",
+                FactionStanding.objects.filter(character=character),
+                'faction',
+                [
+                    FactionStanding(character=character, faction_id=standing['from_id'], standing=standing['standing'])
+                    for standing in standings if standing['from_type'] == "faction"
+                ],
+                ['standing']
+            )
+            self.sync(
+                "corporation standings",
+                CorporationStanding.objects.filter(character=character),
+                'corporation',
+                [
+                    CorporationStanding(character=character, corporation_id=standing['from_id'], standing=standing['standing'])
+                    for standing in standings if standing['from_type'] == "npc_corp"
+                ],
+                ['standing']
+            )
+
+
+    ## Industry
+    def section_industry(self, character, jobs):
+        Station.prefetch([j['facility_id'] for j in jobs])
+
+        db_jobs = []
+        for job in jobs:
+            db_jobs.append(IndustryJob(
+                job_id=job['job_id'],
+                installer_id=job['installer_id'],
+                activity=job['activity_id'],
+                output_location_id=job['output_location_id'],
+                runs=job['runs'],
+                team_id=0,  # This doesn't exist anymore so it's not in ESI
+                licensed_runs=job['licensed_runs'],
+                duration=job['duration'],
+                start_date=self.parse_api_date(job['start_date']),
+                end_date=self.parse_api_date(job['end_date']),
+                pause_date=self.parse_api_date(job['pause_date']) if "pause_date" in job else datetime(0001, 1, 1, 1, 0),
+                completed_date=self.parse_api_date(job['completed_date']) if "completed_date" in job else datetime(0001, 1, 1, 1, 0),
+                blueprint_id=job['blueprint_type_id'],
+                character=character,
+                corporation=None,
+                product_id=job['product_type_id'],
+                status=IndustryJobStatusEnum[job['status']].value,
+
+                # POSes are getting removed soon so we're just going to
+                # assume the facility is a station/structure
+                system_id=Station.get_or_create(job['facility_id'], self.api).system_id
+            ))
 
-            # Fix status of stuck jobs
-            job_map = map(lambda x: x['job_id'], jobs)
-            for job in IndustryJob.objects.filter(
-                    character=character,
-                    status=IndustryJob.ACTIVE_STATUS
-                ).exclude(
-                    job_id__in=job_map
-                ):
-
-                # Set stuck jobs to delivered
-                job.status = IndustryJob.DELIVERED_STATUS
-                job.save()
-
-        ## Orders
         with db.transaction.atomic():
-            orders = self.api.get("/v1/characters/$id/orders/")
-
-            # Delete orders if they no longer exist
-            order_map = map(lambda x: x['order_id'], orders)
-            MarketOrder.objects.filter(character=character).exclude(order_id__in=order_map).delete()
-
-            for order in orders:
-                db_order = MarketOrder.objects.filter(order_id=order['order_id'])
-                if len(db_order) == 1:
-                    db_order = db_order[0]
-                else:
-                    db_order = MarketOrder(
-                        order_id=order['order_id'],
-                        character=character,
-                        creator_character_id=character.id,
-                        escrow=order['escrow'],
-                        buy_order=order['is_buy_order'],
-                        volume_entered=order['volume_total'],
-                        corp_wallet_id=None,
-                        item_id=order['type_id'],
-                        station=Station.get_or_create(order['location_id'], self.api)
-                    )
+            # Finished jobs drop out of ESI, they're kept as history
+            self.sync(
+                "industry jobs",
+                IndustryJob.objects.filter(character=character),
+                'job_id',
+                db_jobs,
+                ['status', 'pause_date', 'completed_date'],
+                delete=False
+            )
 
-                db_order.price = order['price']
-                db_order.total_price = order['price'] * order['volume_remain']
-                db_order.volume_remaining = order['volume_remain']
-                db_order.minimum_volume = order['min_volume']
-                db_order.issued = self.parse_api_date(order['issued'])
-                db_order.expires = db_order.issued + timedelta(days=order['duration'])
-                db_order.save()
+            # Fix status of stuck jobs
+            IndustryJob.objects.filter(
+                character=character,
+                status=IndustryJob.ACTIVE_STATUS
+            ).exclude(
+                job_id__in=[job['job_id'] for job in jobs]
+            ).update(
+                status=IndustryJob.DELIVERED_STATUS
+            )
+
+
+    ## Orders
+    def section_orders(self, character, orders):
+        Station.prefetch([o['location_id'] for o in orders])
+
+        db_orders = []
+        for order in orders:
+            issued = self.parse_api_date(order['issued'])
+            db_orders.append(MarketOrder(
+                order_id=order['order_id'],
+                character=character,
+                creator_character_id=character.id,
+                escrow=order['escrow'],
+                buy_order=order['is_buy_order'],
+                volume_entered=order['volume_total'],
+                corp_wallet_id=None,
+                item_id=order['type_id'],
+                station=Station.get_or_create(order['location_id'], self.api),
+                price=order['price'],
+                total_price=order['price'] * order['volume_remain'],
+                volume_remaining=order['volume_remain'],
+                minimum_volume=order['min_volume'],
+                issued=issued,
+                expires=issued + timedelta(days=order['duration'])
+            ))
 
+        # Orders that no longer exist are deleted
+        self.sync(
+            "market orders",
+            MarketOrder.objects.filter(character=character),
+            'order_id',
+            db_orders,
+            ['price', 'total_price', 'volume_remaining', 'minimum_volume', 'issued', 'expires']
+        )
 
-        ## Mails
-        mails = self.api.get("/v1/characters/$id/mail/")
 
+    ## Mails
+    def section_mail(self, character, mails):
         # Filter out mails we already have
         if mails is not None:
-            db_mail_ids = MailMessage.objects.filter(
+            db_mail_ids = set(MailMessage.objects.filter(
                 character=character
-            ).values_list('message_id', flat=True)
+            ).values_list('message_id', flat=True))
             mails = filter(lambda x: x['mail_id'] not in db_mail_ids, mails)
 
             mail_task = ESI_MailFetchTask()
             for mail in mails:
-                mail_task.apply_async(args=[token_id, mail], countdown=30)
+                # This section can run again before the last run's fetches do
+                if cache.add("esi:mail:%s:%s" % (character.id, mail['mail_id']), 1, ESI_MAIL_QUEUED_TIME):
+                    mail_task.apply_async(args=[self.api.token.id, mail], countdown=30)
 
 
-        ## PI
-        try:
-            with db.transaction.atomic():
-                planets = self.api.get("/v1/characters/$id/planets/")
-
-                # Delete colonies that no longer exist
-                planet_map = map(lambda x: x['planet_id'], planets)
-                Colony.objects.filter(character=character).exclude(planet_id__in=planet_map).delete()
-
-                for planet in planets:
-                    db_planet = Colony.objects.filter(character=character, planet_id=planet['planet_id'])
-                    if len(db_planet) == 1:
-                        db_planet = db_planet[0]
-                    else:
-                        db_planet = Colony(
-                            character=character,
-                            system_id=planet['solar_system_id'],
-                            planet_id=planet['planet_id'],
-                            planet=self.api.get("/v1/universe/planets/%s/" % planet['planet_id'])['name'],
-                            planet_type=planet['planet_type'],
-                            last_update=self.parse_api_date(planet['last_update']),
-                            level=planet['upgrade_level'],
-                            pins=planet['num_pins']
-                        )
-                    db_planet.save()
-
-                    # Get planet details
-                    details = self.api.get("/v3/characters/$id/planets/%s/" % planet['planet_id'])
-
-                    # Delete the pins that no longer exist
-                    pin_map = map(lambda x: x['pin_id'], details['pins'])
-                    Pin.objects.filter(colony=db_planet).exclude(pin_id__in=pin_map).delete()
-
-                    for pin in details['pins']:
-                        db_pin = Pin.objects.filter(pin_id=pin['pin_id'])
-                        if len(db_pin) == 1:
-                            db_pin = db_pin[0]
-                        else:
-                            db_pin = Pin(
-                                pin_id=pin['pin_id'],
-                                colony=db_planet,
-                                type_id=pin['type_id']
-                            )
-
-                        if "schematic_id" in pin:
-                            db_pin.schematic = pin['schematic_id']
-                        if "extractor_details" in pin:
-                            db_pin.cycle_time = pin['extractor_details']['cycle_time']
-                            db_pin.quantity_per_cycle = pin['extractor_details']['qty_per_cycle']
-                            db_pin.installed = self.parse_api_date(pin['install_time'])
-                            db_pin.expires = self.parse_api_date(pin['expiry_time'])
-                        if "contents" in pin:
-                            # Clear contents
-                            PinContent.objects.filter(pin=db_pin).delete()
-
-                            # Add new contents
-                            contents = []
-                            for item in pin['contents']:
-                                content = PinContent(
-                                    pin=db_pin,
-                                    item_id=item['type_id'],
-                                    quantity=item['amount']
-                                )
-                                contents.append(content)
-                                content.save()
-
-                            # Calculate content size
-                            db_pin.content_size = sum(map(lambda x: x.quantity * x.item.volume, contents))
-
-                        db_pin.save()
-        except Exception:
-            pass
-
-
-        ## Contracts
+    ## PI
+    def section_planets(self, character, planets):
         with db.transaction.atomic():
-            try:
-                contracts = self.api.get("/v1/characters/$id/contracts/")
-
-                for contract in contracts:
-                    db_contract = Contract.objects.filter(contract_id=contract['contract_id'])
-                    if len(db_contract) > 0:
-                        db_contract = db_contract[0]
-                    else:
-                        db_contract = Contract(
-                            character=character,
-                            contract_id=contract['contract_id']
-                        )
-
-                    # Update info
-                    if "issuer_id" in contract:
-                        db_contract.issuer_char = Character.get_or_create(contract['issuer_id'])
-                    db_contract.issuer_corp = Corporation.get_or_create(contract['issuer_corporation_id'])
-                    db_contract.assignee_id = contract['assignee_id']
-                    db_contract.acceptor_id = contract['acceptor_id']
-
-                    db_contract.start_station = Station.get_or_create(contract['start_location_id'], self.api)
-                    db_contract.end_station = Station.get_or_create(contract['end_location_id'], self.api)
-
-                    db_contract.type = self.contract_types[contract['type']]
-                    db_contract.status = self.contract_states[contract['status']]
-                    db_contract.title = contract['title']
-                    db_contract.for_corp = contract['for_corporation']
-                    if contract['availability'] == "public":
-                        db_contract.public = True
-
-                    db_contract.date_issued = self.parse_api_date(contract['date_issued'])
-                    db_contract.date_expired = self.parse_api_date(contract['date_expired'])
-                    if "date_accepted" in contract:
-                        db_contract.date_accepted = self.parse_api_date(contract['date_accepted'])
-                    if "date_completed" in contract:
-                        db_contract.date_completed = self.parse_api_date(contract['date_completed'])
-                    db_contract.num_days = contract['days_to_complete']
-
-                    db_contract.price = contract['price']
-                    db_contract.reward = contract['reward']
-                    db_contract.collateral = contract['collateral']
-                    if "buyout" in contract:
-                        db_contract.buyout = contract['buyout']
-                    db_contract.volume = contract['volume']
-
-                    db_contract.save()
-
-                    # Items
-                    if not db_contract.retrieved_items:
-                        items = self.api.get("/v1/characters/$id/contracts/%s/items" % contract['contract_id'])
-                        for item in items:
-                            db_item = ContractItem(
-                                id=item['record_id'],
-                                contract=db_contract,
-                                item_id=item['type_id'],
-                                quantity=item['quantity'],
-                                singleton=item['is_singleton'],
-                                included=item['is_included']
-                            )
-                            if "raw_quantity" in item:
-                                db_item.raw_quantity = item['raw_quantity']
-                            db_item.save()
-
-                        db_contract.retrieved_items = True
-                        db_contract.save()
-            except Exception:
-                # This character hasn't been re-added for contracts
-                pass
-
-
-        ## Fatigue
-        try:
-            fatigue = self.api.get("/v1/characters/$id/fatigue/")
-
-            charDetails.last_jump_date = self.parse_api_date(fatigue['last_jump_date'])
-            charDetails.fatigue_expire_date = self.parse_api_date(fatigue['jump_fatigue_expire_date'])
-            charDetails.save()
-        except Exception:
-            # This character hasn't been re-added since 24/08/17
-            pass
-
+            # Delete colonies that no longer exist
+            planet_map = map(lambda x: x['planet_id'], planets)
+            Colony.objects.filter(character=character).exclude(planet_id__in=planet_map).delete()
+
+            for planet in planets:
+                db_planet = Colony.objects.filter(character=character, planet_id=planet['planet_id'])
+                if len(db_planet) == 1:
+                    db_planet = db_planet[0]
+                else:
+                    db_planet = Colony(
+                        character=character,
+                        system_id=planet['solar_system_id'],
+                        planet_id=planet['planet_id'],
+                        planet=self.api.get("/v1/universe/planets/%s/" % planet['planet_id'])['name'],
+                        planet_type=planet['planet_type'],
+                        last_update=self.parse_api_date(planet['last_update']),
+                        level=planet['upgrade_level'],
+                        pins=planet['num_pins']
+                    )
+                db_planet.save()
+
+                # Get planet details
+                details = self.api.get("/v3/characters/$id/planets/%s/" % planet['planet_id'])
+
+                self.sync_pins(db_planet, details['pins'])
+
+
+    # Syncs a colony's pins and rewrites what's in them
+    def sync_pins(self, colony, pins):
+        volumes = dict(Item.objects.filter(
+            id__in=[item['type_id'] for pin in pins for item in pin.get('contents', [])]
+        ).values_list('id', 'volume'))
+
+        db_pins = []
+        for pin in pins:
+            db_pin = Pin(
+                pin_id=pin['pin_id'],
+                colony=colony,
+                type_id=pin['type_id'],
+                schematic=pin.get('schematic_id', 0),
+                content_size=sum(item['amount'] * volumes.get(item['type_id'], 0) for item in pin.get('contents', []))
+            )
+            if "extractor_details" in pin:
+                db_pin.cycle_time = pin['extractor_details']['cycle_time']
+                db_pin.quantity_per_cycle = pin['extractor_details']['qty_per_cycle']
+                db_pin.installed = self.parse_api_date(pin['install_time'])
+                db_pin.expires = self.parse_api_date(pin['expiry_time'])
+            db_pins.append(db_pin)
 
-        ## Implants
         with db.transaction.atomic():
-            try:
-                implants = self.api.get("/v1/characters/$id/implants/")
-
-                charDetails.implants.clear()
-                for implant in implants:
-                    charDetails.implants.add(implant)
-
-            except Exception:
-                # This character hasn't been re-added since 24/08/17
-                pass
-
+            # Pins that no longer exist are deleted along with their contents
+            self.sync(
+                "planetary pins",
+                Pin.objects.filter(colony=colony),
+                'pin_id',
+                db_pins,
+                ['type', 'schematic', 'cycle_time', 'quantity_per_cycle', 'installed', 'expires', 'content_size']
+            )
+
+            pin_ids = dict(Pin.objects.filter(colony=colony).values_list('pin_id', 'id'))
+            PinContent.objects.filter(pin__colony=colony).delete()
+            PinContent.objects.bulk_create([
+                PinContent(pin_id=pin_ids[pin['pin_id']], item_id=item['type_id'], quantity=item['amount'])
+                for pin in pins for item in pin.get('contents', [])
+            ])
+
+
+    ## Contracts
+    def section_contracts(self, character, contracts):
+        with db.transaction.atomic():
+            contracts = list(self.api.iter_pages("/v1/characters/$id/contracts/"))
+
+            # Look up every issuer at once
+            resolver = EntityResolver()
+            issuers = resolver.characters([c['issuer_id'] for c in contracts if "issuer_id" in c])
+            issuer_corps = resolver.corporations([c['issuer_corporation_id'] for c in contracts])
+            Station.prefetch([c['start_location_id'] for c in contracts] + [c['end_location_id'] for c in contracts])
+
+            for contract in contracts:
+                db_contract = Contract.objects.filter(contract_id=contract['contract_id'])
+                if len(db_contract) > 0:
+                    db_contract = db_contract[0]
+                else:
+                    db_contract = Contract(
+                        character=character,
+                        contract_id=contract['contract_id']
+                    )
 
-        # If we reach this far the token is active again
-        character.esitoken.status = True
-        character.esitoken.save()
-        print "Finished updating %s:%s" % (character.id, character.name)
+                # Update info
+                if "issuer_id" in contract:
+                    db_contract.issuer_char = issuers.get(contract['issuer_id'])
+                db_contract.issuer_corp = issuer_corps.get(contract['issuer_corporation_id']) or \
+                    Corporation.get_or_create(contract['issuer_corporation_id'])
+                db_contract.assignee_id = contract['assignee_id']
+                db_contract.acceptor_id = contract['acceptor_id']
+
+                db_contract.start_station = Station.get_or_create(contract['start_location_id'], self.api)
+                db_contract.end_station = Station.get_or_create(contract['end_location_id'], self.api)
+
+                db_contract.type = self.contract_types[contract['type']]
+                db_contract.status = self.contract_states[contract['status']]
+                db_contract.title = contract['title']
+                db_contract.for_corp = contract['for_corporation']
+                if contract['availability'] == "public":
+                    db_contract.public = True
+
+                db_contract.date_issued = self.parse_api_date(contract['date_issued'])
+                db_contract.date_expired = self.parse_api_date(contract['date_expired'])
+                if "date_accepted" in contract:
+                    db_contract.date_accepted = self.parse_api_date(contract['date_accepted'])
+                if "date_completed" in contract:
+                    db_contract.date_completed = self.parse_api_date(contract['date_completed'])
+                db_contract.num_days = contract['days_to_complete']
+
+                db_contract.price = contract['price']
+                db_contract.reward = contract['reward']
+                db_contract.collateral = contract['collateral']
+                if "buyout" in contract:
+                    db_contract.buyout = contract['buyout']
+                db_contract.volume = contract['volume']
+
+                db_contract.save()
+
+                # Items
+                if not db_contract.retrieved_items:
+                    items = self.api.get("/v1/characters/$id/contracts/%s/items" % contract['contract_id'])
+                    for item in items:
+                        db_item = ContractItem(
+                            id=item['record_id'],
+                            contract=db_contract,
+                            item_id=item['type_id'],
+                            quantity=item['quantity'],
+                            singleton=item['is_singleton'],
+                            included=item['is_included']
+                        )
+                        if "raw_quantity" in item:
+                            db_item.raw_quantity = item['raw_quantity']
+                        db_item.save()
 
+                    db_contract.retrieved_items = True
+                    db_contract.save()
 
 
     # Generates the last known location string
@@ -604,3 +991,48 @@ class ESI_CharacterInfo(APITask):
                 return ""
 
         return ""
+
+
+# Syncs a single section of a character, see SECTIONS
+class ESI_CharacterSection(ESI_CharacterInfo):
+    name = "thing.esi.character_section"
+
+
+    def run(self, token_id, section):
+        self.api = self.get_api(token_id)
+        self.activity = {}
+
+        try:
+            endpoints = self.sections[section][0]
+
+            # Fetched while holding the lock, see ESI_CharacterInfo.run()
+            with TokenLock(token_id):
+                results = self.api.get_many(endpoints)
+                if not self.process_section(section, results):
+                    # The character section hasn't run yet, try again shortly
+                    self.schedule(section, datetime.now() + timedelta(minutes=1))
+
+        except TokenLocked:
+            # Another sync has the token, we'll catch up after it
+            self.schedule(section, datetime.now() + timedelta(seconds=ESI_SYNC_LOCK_RETRY))
+
+        except ESIUnavailableError:
+            # APITask retries these with a backoff, the section stays leased
+            # and in flight until then, see retrying()
+            raise
+
+        except Exception as e:
+            # A missing scope fails the same way every time, don't leave the
+            # section leased or try it again straight away
+            print "Failed to update %s for token id %s: %s" % (section, token_id, e)
+            endpoints, shortest, longest = self.sections[section]
+            delay = min(max(ESI_SYNC_FAILURE_DELAY, shortest), longest)
+            self.schedule(section, datetime.now() + timedelta(seconds=delay))
+
+        get_due_queue().finish(self.api.token.user_id, token_id, section)
+
+
+    # Holds on to the section until the retry has had its turn, so the
+    # spawner doesn't hand it out again in the meantime
+    def retrying(self, countdown, token_id, section):
+        get_due_queue().extend(self.api.token.user_id, token_id, section, countdown + ESI_SECTION_LEASE)
@@ -21,7 +21,8 @@ class ESI_ClearInvalidTokens(APITask):
         deleted = 0
         for token in tokens:
             api = ESI(token)
-            if not api._refresh_access_token(save=False):
+            # Only when the login server says so, not when it's down
+            if api._refresh_access_token(save=False) is False:
                 print "Deleting token for %s" % token.character.name
                 token.delete()
                 deleted = deleted + 1
@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta
+
+from .apitask import APITask
+
+from evething import local_settings
+
+from thing.esi import ESI
+from thing.esi_resolver import EntityResolver
+from thing.models import Alliance, Corporation
+
+
+# Corporations and alliances older than this many hours get refreshed
+ESI_ENTITY_REFRESH_AGE = getattr(local_settings, "ESI_ENTITY_REFRESH_AGE", 48)
+# Most of each refreshed per run, oldest first
+ESI_ENTITY_REFRESH_BATCH = getattr(local_settings, "ESI_ENTITY_REFRESH_BATCH", 500)
+
+
+# get_or_create hands back stale corporations and alliances as they are, this
+# brings them up to date in batches instead. The rows' last_updated is the
+# queue, so there's nothing to lose if a run is skipped.
+class ESI_EntityRefresh(APITask):
+    name = "thing.esi.entity_refresh"
+
+
+    def run(self):
+        self.api = ESI()
+        cutoff = datetime.now() - timedelta(hours=ESI_ENTITY_REFRESH_AGE)
+
+        self.refresh_alliances(cutoff)
+        self.refresh_corporations(cutoff)
+
+
+    def refresh_alliances(self, cutoff):
+        alliances = list(Alliance.objects.filter(last_updated__lt=cutoff).order_by('last_updated')[:ESI_ENTITY_REFRESH_BATCH])
+        results = self.api.get_many(["/v3/alliances/%s/" % a.id for a in alliances])
+        # Whatever failed is tried again on a later run
+        results = [None if isinstance(r, Exception) else r for r in results]
+
+        refreshed = []
+        for alliance, result in zip(alliances, results):
+            if result is None:
+                continue
+
+            refreshed.append(alliance.id)
+            if alliance.name != result['name'] or alliance.short_name != result['ticker']:
+                Alliance.objects.filter(id=alliance.id).update(
+                    name=result['name'],
+                    short_name=result['ticker']
+                )
+
+        Alliance.objects.filter(id__in=refreshed).update(last_updated=datetime.now())
+        print "Refreshed %s of %s stale alliances" % (len(refreshed), len(alliances))
+
+
+    def refresh_corporations(self, cutoff):
+        corporations = list(Corporation.objects.filter(last_updated__lt=cutoff).order_by('last_updated')[:ESI_ENTITY_REFRESH_BATCH])
+        results = self.api.get_many(["/v4/corporations/%s/" % c.id for c in corporations])
+        results = [None if isinstance(r, Exception) else r for r in results]
+
+        # Corporations can move to alliances we haven't seen yet. Any we
+        # couldn't create are left off until a later refresh.
+        alliances = EntityResolver().alliances([r['alliance_id'] for r in results if r is not None and "alliance_id" in r])
+
+        refreshed = 0
+        for corporation, result in zip(corporations, results):
+            if result is None:
+                continue
+
+            # Stamped one at a time so a failure part way through doesn't
+            # send the ones already done round again
+            alliance_id = result.get('alliance_id')
+            if alliance_id not in alliances:
+                alliance_id = None
+            Corporation.objects.filter(id=corporation.id).update(
+                name=result['name'],
+                ticker=result['ticker'],
+                alliance_id=alliance_id,
+                last_updated=datetime.now()
+            )
+            refreshed += 1
+
+        print "Refreshed %s of %s stale corporations" % (refreshed, len(corporations))
@@ -1,6 +1,7 @@
 from .apitask import APITask
 
 from thing.esi import ESI
+from thing.esi_resolver import EntityResolver
 
 from thing.models import *
 
@@ -15,13 +16,18 @@ class ESI_MailFetchTask(APITask):
         self.api = ESI(token)
         character = token.character
 
-        to_characters = map(
-            lambda x: Character.get_or_create(x['recipient_id']),
-            filter(
-                lambda x: x['recipient_type'] == "character",
-                mail['recipients']
-            )
-        )
+        # Another fetch of the same mail got there first
+        if MailMessage.objects.filter(character=character, message_id=mail['mail_id']).exists():
+            return
+
+        # The sender and every recipient in one go
+        character_ids = [
+            x['recipient_id'] for x in mail['recipients']
+            if x['recipient_type'] == "character"
+        ]
+        characters = EntityResolver().characters(character_ids + [mail['from']])
+
+        to_characters = [characters[id] for id in character_ids if id in characters]
         to_corp_or_alliance_id = filter(
             lambda x: x['recipient_type'] in ["corporation", "alliance"],
             mail['recipients']
@@ -42,11 +48,6 @@ class ESI_MailFetchTask(APITask):
 
         body = self.api.get("/v1/characters/$id/mail/%s/" % mail['mail_id'])
 
-        try:
-            Character.get_or_create(mail['from'])
-        except Exception:
-            pass
-
         db_mail = MailMessage(
             character=character,
             message_id=mail['mail_id'],
@@ -1,2 +1,3 @@
 from thing.tests.models import *  # NOPEP8
 from thing.tests.views import *  # NOPEP8
+from thing.tests.esi import *  # NOPEP8
@@ -0,0 +1,258 @@
+from decimal import Decimal
+from time import time
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from thing.esi import parse_cache_ttl
+from thing.esi_assets import AssetTree
+from thing.esi_sync import sync_rows
+from thing.esi_limits import ESIErrorLimiter, ESI_ERROR_LIMIT_MARGIN, ESI_ERROR_LIMIT_SLOWDOWN, \
+    ESICircuitBreaker, ESI_BREAKER_THRESHOLD
+from thing.models import Character, Faction, FactionStanding
+
+
+class ParseCacheTTLTestCase(TestCase):
+    def test_max_age(self):
+        self.assertEqual(parse_cache_ttl({'Cache-Control': 'public, max-age=300'}), 300)
+
+        # max-age wins over Expires
+        self.assertEqual(parse_cache_ttl({
+            'Cache-Control': 'max-age=60',
+            'Date': 'Sat, 17 Oct 2026 12:00:00 GMT',
+            'Expires': 'Sat, 17 Oct 2026 13:00:00 GMT',
+        }), 60)
+
+    def test_expires(self):
+        # Measured against ESI's Date header, not our clock
+        self.assertEqual(parse_cache_ttl({
+            'Date': 'Sat, 17 Oct 2026 12:00:00 GMT',
+            'Expires': 'Sat, 17 Oct 2026 12:05:00 GMT',
+        }), 300)
+
+        # Already expired
+        self.assertEqual(parse_cache_ttl({
+            'Date': 'Sat, 17 Oct 2026 12:05:00 GMT',
+            'Expires': 'Sat, 17 Oct 2026 12:00:00 GMT',
+        }), 0)
+
+    def test_no_cache(self):
+        self.assertEqual(parse_cache_ttl({'Cache-Control': 'no-cache'}), 0)
+        self.assertEqual(parse_cache_ttl({
+            'Cache-Control': 'no-store, max-age=300',
+            'Expires': 'Sat, 17 Oct 2026 12:05:00 GMT',
+        }), 0)
+
+    def test_no_headers(self):
+        self.assertEqual(parse_cache_ttl({}), None)
+        self.assertEqual(parse_cache_ttl({'Expires': 'garbage'}), None)
+
+
+class ESIErrorLimiterTestCase(TestCase):
+    def setUp(self):
+        super(ESIErrorLimiterTestCase, self).setUp()
+
+        self.limiter = ESIErrorLimiter()
+        cache.delete(self.limiter.key)
+
+    def tearDown(self):
+        cache.delete(self.limiter.key)
+        super(ESIErrorLimiterTestCase, self).tearDown()
+
+    def test_no_state(self):
+        self.assertEqual(self.limiter.delay(), 0)
+
+        # Responses without the headers don't change that
+        self.limiter.update({})
+        self.assertEqual(self.limiter.delay(), 0)
+
+    def test_plenty_left(self):
+        self.limiter.update({
+            'X-ESI-Error-Limit-Remain': str(ESI_ERROR_LIMIT_SLOWDOWN + 10),
+            'X-ESI-Error-Limit-Reset': '30',
+        })
+        self.assertEqual(self.limiter.delay(), 0)
+
+    def test_running_low(self):
+        # What's left above the margin is spread over the rest of the window
+        self.limiter.update({
+            'X-ESI-Error-Limit-Remain': str(ESI_ERROR_LIMIT_MARGIN + 20),
+            'X-ESI-Error-Limit-Reset': '40',
+        })
+        self.assertAlmostEqual(self.limiter.delay(), 2, delta=0.2)
+
+    def test_out_of_errors(self):
+        self.limiter.update({
+            'X-ESI-Error-Limit-Remain': str(ESI_ERROR_LIMIT_MARGIN),
+            'X-ESI-Error-Limit-Reset': '30',
+        })
+        self.assertAlmostEqual(self.limiter.delay(), 30, delta=2)
+
+        self.limiter.exhausted(reset=10)
+        self.assertAlmostEqual(self.limiter.delay(), 10, delta=2)
+
+    def test_out_of_order_responses(self):
+        # A response from the same window with more errors left is older
+        self.limiter.update({
+            'X-ESI-Error-Limit-Remain': str(ESI_ERROR_LIMIT_MARGIN),
+            'X-ESI-Error-Limit-Reset': '30',
+        })
+        self.limiter.update({
+            'X-ESI-Error-Limit-Remain': '100',
+            'X-ESI-Error-Limit-Reset': '30',
+        })
+        self.assertTrue(self.limiter.delay() > 0)
+
+    def test_window_reset(self):
+        self.limiter._store(0, time() - 1)
+        self.assertEqual(self.limiter.delay(), 0)
+
+
+class ESICircuitBreakerTestCase(TestCase):
+    group = 'tests/breaker'
+
+    def setUp(self):
+        super(ESICircuitBreakerTestCase, self).setUp()
+
+        self.breaker = ESICircuitBreaker()
+        self._clear()
+
+    def tearDown(self):
+        self._clear()
+        super(ESICircuitBreakerTestCase, self).tearDown()
+
+    def _clear(self):
+        cache.delete('esi:breaker:%s:failures' % self.group)
+        cache.delete('esi:breaker:%s:open' % self.group)
+
+    def test_group(self):
+        self.assertEqual(self.breaker.group('/v3/characters/$id/assets/'), 'characters/assets')
+        self.assertEqual(self.breaker.group('/v3/characters/90000001/assets/?page=2'), 'characters/assets')
+        self.assertEqual(self.breaker.group('/v2/universe/structures/%s/'), 'universe/structures')
+        self.assertEqual(self.breaker.group('/latest/markets/10000002/orders/'), 'markets/orders')
+
+    def test_threshold(self):
+        for i in range(ESI_BREAKER_THRESHOLD - 1):
+            self.breaker.failure(self.group)
+        self.assertFalse(self.breaker.is_open(self.group))
+
+        self.breaker.failure(self.group)
+        self.assertTrue(self.breaker.is_open(self.group))
+
+    def test_success_resets(self):
+        for i in range(ESI_BREAKER_THRESHOLD - 1):
+            self.breaker.failure(self.group)
+        self.breaker.success(self.group)
+
+        # The count starts again, failures have to be in a row
+        for i in range(ESI_BREAKER_THRESHOLD - 1):
+            self.breaker.failure(self.group)
+        self.assertFalse(self.breaker.is_open(self.group))
+
+
+class AssetTreeTestCase(TestCase):
+    def setUp(self):
+        super(AssetTreeTestCase, self).setUp()
+
+        # A ship in a station with a container in its cargo holding an item,
+        # and a ship in space
+        self.tree = AssetTree([
+            {'item_id': 3, 'location_id': 2},
+            {'item_id': 2, 'location_id': 1},
+            {'item_id': 1, 'location_id': 60003760},
+            {'item_id': 4, 'location_id': 30000142},
+        ])
+
+    def test_parent(self):
+        self.assertEqual(self.tree.parent(self.tree.items[3]), 2)
+        self.assertEqual(self.tree.parent(self.tree.items[2]), 1)
+        self.assertEqual(self.tree.parent(self.tree.items[1]), 0)
+        self.assertEqual(self.tree.parent(self.tree.items[4]), 0)
+
+    def test_root(self):
+        self.assertEqual(self.tree.root(self.tree.items[3]), 60003760)
+        self.assertEqual(self.tree.root(self.tree.items[2]), 60003760)
+        self.assertEqual(self.tree.root(self.tree.items[1]), 60003760)
+        self.assertEqual(self.tree.root(self.tree.items[4]), 30000142)
+
+    def test_roots(self):
+        self.assertEqual(self.tree.roots(), set([60003760, 30000142]))
+
+    def test_self_containing(self):
+        tree = AssetTree([
+            {'item_id': 1, 'location_id': 1},
+            {'item_id': 2, 'location_id': 3},
+            {'item_id': 3, 'location_id': 2},
+            {'item_id': 4, 'location_id': 2},
+            {'item_id': 5, 'location_id': 60003760},
+        ])
+
+        # Items in a loop, and anything in them, have nowhere to go
+        self.assertEqual(tree.root(tree.items[1]), None)
+        self.assertEqual(tree.root(tree.items[2]), None)
+        self.assertEqual(tree.root(tree.items[4]), None)
+        self.assertEqual(tree.roots(), set([60003760]))
+
+
+class SyncRowsTestCase(TestCase):
+    def setUp(self):
+        super(SyncRowsTestCase, self).setUp()
+
+        self.character = Character.objects.create(id=90000001, name='Test Character')
+        for id in range(500001, 500005):
+            Faction.objects.create(id=id, name='Faction %s' % id)
+
+        FactionStanding.objects.create(character=self.character, faction_id=500001, standing=Decimal('5.23'))
+        FactionStanding.objects.create(character=self.character, faction_id=500002, standing=Decimal('-2.00'))
+        FactionStanding.objects.create(character=self.character, faction_id=500003, standing=Decimal('1.00'))
+
+    def _sync(self, standings, delete=True):
+        return sync_rows(
+            FactionStanding.objects.filter(character=self.character),
+            'faction',
+            [
+                FactionStanding(character=self.character, faction_id=faction_id, standing=standing)
+                for faction_id, standing in standings
+            ],
+            ['standing'],
+            delete=delete
+        )
+
+    def _standings(self):
+        return dict(FactionStanding.objects.filter(character=self.character).values_list('faction_id', 'standing'))
+
+    def test_counts(self):
+        # 500001 is unchanged, 500002 changed, 500003 gone and 500004 new
+        counts = self._sync([(500001, 5.23), (500002, 3.5), (500004, 0.5)])
+        self.assertEqual(counts, {'created': 1, 'updated': 1, 'deleted': 1})
+
+        self.assertEqual(self._standings(), {
+            500001: Decimal('5.23'),
+            500002: Decimal('3.50'),
+            500004: Decimal('0.50'),
+        })
+
+        # Nothing to do the second time round
+        counts = self._sync([(500001, 5.23), (500002, 3.5), (500004, 0.5)])
+        self.assertEqual(counts, {'created': 0, 'updated': 0, 'deleted': 0})
+
+    def test_float_matches_decimal(self):
+        # ESI's floats compare equal to the Decimals we read back
+        counts = self._sync([(500001, 5.23), (500002, -2.0), (500003, 1)])
+        self.assertEqual(counts, {'created': 0, 'updated': 0, 'deleted': 0})
+
+    def test_no_delete(self):
+        counts = self._sync([(500001, 5.23)], delete=False)
+        self.assertEqual(counts, {'created': 0, 'updated': 0, 'deleted': 0})
+        self.assertEqual(len(self._standings()), 3)
+
+    def test_shared_update(self):
+        # Rows changing to the same value are updated together
+        counts = self._sync([(500001, 0), (500002, 0), (500003, 0)])
+        self.assertEqual(counts, {'created': 0, 'updated': 3, 'deleted': 0})
+        self.assertEqual(set(self._standings().values()), set([Decimal('0.00')]))
+
+    def test_duplicate_rows(self):
+        # A row ESI sends twice is only created once
+        counts = self._sync([(500001, 5.23), (500002, -2.0), (500003, 1), (500004, 0.5), (500004, 0.5)])
+        self.assertEqual(counts, {'created': 1, 'updated': 0, 'deleted': 0})
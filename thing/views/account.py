@@ -126,7 +126,8 @@ def account_sso_callback(request):
     esi = ESIToken(
         user=request.user,
         access_token=token['access_token'],
-        refresh_token=token['refresh_token']
+        refresh_token=token['refresh_token'],
+        expires_at=datetime.datetime.now() + datetime.timedelta(seconds=token['expires_in'])
     )
 
     # Get the character info from ESI
@@ -141,6 +142,7 @@ def account_sso_callback(request):
         esi = ESIToken.objects.get(user=request.user, characterID=verify['CharacterID'])
         esi.access_token = token['access_token']
         esi.refresh_token = token['refresh_token']
+        esi.expires_at = datetime.datetime.now() + datetime.timedelta(seconds=token['expires_in'])
         esi.added = datetime.datetime.now()
         esi.status = True
 
@@ -153,8 +155,8 @@ def account_sso_callback(request):
     esi.token_type = verify['TokenType']
     esi.save()
 
-    # Call for an update on this token
-    ESI_CharacterInfo().delay(esi.id)
+    # Call for an update on this token, ahead of the scheduled syncs
+    ESI_CharacterInfo().apply_async(args=[esi.id], queue='et_fast')
 
     return redirect('%s#connectedcharacters' % (reverse(account)))
 